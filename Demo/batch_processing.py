@@ -0,0 +1,159 @@
+import os
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+
+from file_processing import process_file, process_file_chunked
+import metrics
+
+
+BatchResult = namedtuple("BatchResult", ["input_path", "output_path", "error", "metrics"])
+
+
+def _process_one(input_path, output_path, chunked=False, instrumented=False, lod_voxel_size=None):
+    """
+    Runs `process_file` for a single scan inside a worker process.
+
+    Parameters:
+    input_path (Path): The path to the input STL file.
+    output_path (Path): The path to save the processed STL file.
+    chunked (bool): Whether to use `process_file_chunked`, which keeps memory bounded for huge scans.
+    instrumented (bool): Whether to collect per-stage metrics (the parent process has instrumentation enabled).
+    lod_voxel_size (float): If given, level-of-detail point clouds are saved next to the output (in-memory mode only).
+
+    Returns:
+    tuple: A tuple containing None on success, otherwise a short description of the error,
+    and the metrics record of the file (or None).
+
+    Explanation:
+    - Any exception is caught and returned as text so one bad scan does not stop the batch.
+    - A partially written output file is removed so it is not picked up by `rename_files`.
+    - In a worker process, instrumentation is enabled without an output file; the record is returned
+      to the parent, which writes it. The pool initializer clears the state a forked worker inherits,
+      so the record is not also written by the worker.
+    """
+    if instrumented and not metrics.is_enabled():
+        metrics.enable()
+    error = None
+    record = None
+    try:
+        with metrics.file_metrics(input_path.name) as record:
+            if chunked:
+                process_file_chunked(input_path, output_path)
+            else:
+                process_file(input_path, output_path, lod_voxel_size=lod_voxel_size)
+    except Exception as e:
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        error = f"{type(e).__name__}: {e}"
+    return error, record
+
+
+def _collect(future, i, jobs, outcomes):
+    """
+    Stores the outcome of a finished job of `process_batch`.
+
+    Parameters:
+    future (Future): The finished future of the job.
+    i (int): The index of the job.
+    jobs (list): The (input path, output path) pairs of the batch.
+    outcomes (list): The (error, metrics) pairs of the batch, updated in place.
+
+    Returns:
+    bool: True if the job was lost because its worker pool broke, otherwise False.
+
+    Explanation:
+    - A job lost with a dead worker process is recorded as failed, and its output file is removed
+      because `_process_one` could not clean it up.
+    """
+    broken = False
+    try:
+        outcomes[i] = future.result()
+    except BrokenProcessPool as e:
+        broken = True
+        outcomes[i] = (f"{type(e).__name__}: {e}", None)
+        if os.path.exists(jobs[i][1]):
+            os.remove(jobs[i][1])
+    except Exception as e:  # e.g. the arguments or the result could not be pickled
+        outcomes[i] = (f"{type(e).__name__}: {e}", None)
+    if outcomes[i][1] is not None:
+        metrics.add_record(outcomes[i][1])
+    print(jobs[i][0].name)
+    return broken
+
+
+def process_batch(inputs, output_dir, workers=None, max_in_flight=None, chunked=False, lod_voxel_size=None):
+    """
+    Processes a batch of STL files in parallel using a process pool.
+
+    Parameters:
+    inputs (list): The paths of the input STL files, in the order they should be reported.
+    output_dir (Path or str): The folder where the processed files are saved (same file names).
+    workers (int): The number of worker processes. Defaults to the number of CPUs.
+    max_in_flight (int): The maximum number of scans submitted at once. Defaults to twice the workers.
+    chunked (bool): Whether to align the scans out of core with `process_file_chunked`.
+    lod_voxel_size (float): If given, the finest voxel size of the level-of-detail point clouds saved with each scan.
+
+    Returns:
+    list: A list of `BatchResult` tuples, in the same order as `inputs`.
+
+    Explanation:
+    - Only a bounded number of scans are queued at any time, so memory stays flat on large batches.
+    - Each scan is loaded, aligned, centered and saved by `process_file` in a worker process.
+    - Failures are recorded in the `error` field of the result instead of raising.
+    - If a worker process dies, the scans it took down are recorded as failed and the batch continues
+      in a new process pool.
+    - With instrumentation enabled, the per-stage metrics of each file are in the `metrics` field.
+    - With `workers=1` the files are processed in the current process, which is easier to debug.
+    """
+    output_dir = Path(output_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    jobs = [(Path(input_path), output_dir / Path(input_path).name) for input_path in inputs]
+    workers = workers or os.cpu_count() or 1
+    max_in_flight = max(max_in_flight or 2 * workers, 1)
+
+    instrumented = metrics.is_enabled()
+    outcomes = [(None, None)] * len(jobs)
+    if workers == 1:
+        for i, (input_path, output_path) in enumerate(jobs):
+            print(input_path.name)
+            outcomes[i] = _process_one(input_path, output_path, chunked, instrumented, lod_voxel_size)
+    else:
+        pending = {}
+        next_job = 0
+        executor = None
+        try:
+            while next_job < len(jobs) or pending:
+                if executor is None:
+                    executor = ProcessPoolExecutor(max_workers=workers, initializer=metrics.reset)
+                broken = False
+                while next_job < len(jobs) and len(pending) < max_in_flight:
+                    try:
+                        future = executor.submit(_process_one, *jobs[next_job], chunked, instrumented, lod_voxel_size)
+                    except BrokenProcessPool:
+                        broken = True
+                        break
+                    pending[future] = next_job
+                    next_job += 1
+                if not broken:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        broken = _collect(future, pending.pop(future), jobs, outcomes) or broken
+                if broken:
+                    # A worker process died (e.g. killed for running out of memory); the scans it took down with
+                    # it are recorded as failed and the remaining ones go to a fresh pool
+                    executor.shutdown()
+                    executor = None
+                    for future in list(pending):
+                        _collect(future, pending.pop(future), jobs, outcomes)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+    results = [BatchResult(input_path, output_path, error, metrics)
+               for (input_path, output_path), (error, metrics) in zip(jobs, outcomes)]
+    for result in results:
+        if result.error:
+            print(f"Failed: {result.input_path.name} ({result.error})")
+    return results
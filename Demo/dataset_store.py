@@ -0,0 +1,229 @@
+import json
+import os
+import re
+from collections import namedtuple
+from pathlib import Path
+
+import numpy as np
+
+from file_processing import load_stl
+from stl_io import merge_vertices
+
+
+# Files of a packed dataset store, inside the store folder
+VERTICES_NAME = "vertices.f32"
+FACES_NAME = "faces.i32"
+INDEX_NAME = "index.json"
+STORE_VERSION = 1
+
+VERTEX_DTYPE = np.dtype("<f4")
+FACE_DTYPE = np.dtype("<i4")
+
+# Name given by `rename_files`: index, original ID, month and year
+PROCESSED_NAME_PATTERN = re.compile(r"^(\d+)_(.+)_(\d{2})_(\d{2})$")
+ID_PATTERN = re.compile(r"\d{5,6}")
+FILE_TYPES = ("face_scan", "mask", "template")
+
+# Memory-mapped vertices and faces of all scans, and the metadata of each scan with its offsets into them
+PackedDataset = namedtuple("PackedDataset", ["vertices", "faces", "scans", "vertex_offsets", "face_offsets"])
+
+
+def scan_metadata(file_path):
+    """
+    Extracts the patient ID, date and file type of a processed scan from its name.
+
+    Parameters:
+    file_path (Path): The path to the processed STL file (see `rename_files`).
+
+    Returns:
+    dict: The name, patient ID, month, year and file type of the scan. Unknown fields are None.
+    """
+    file_path = Path(file_path)
+    metadata = {"name": file_path.name, "patient_id": None, "month": None, "year": None, "file_type": "face_scan"}
+    match = PROCESSED_NAME_PATTERN.match(file_path.stem)
+    original_id = match.group(2) if match else file_path.stem
+    if match:
+        metadata["month"] = int(match.group(3))
+        metadata["year"] = int(match.group(4))
+    id_match = ID_PATTERN.search(original_id)
+    if id_match:
+        metadata["patient_id"] = id_match.group()
+    for file_type in FILE_TYPES:
+        if file_type in original_id:
+            metadata["file_type"] = file_type
+    return metadata
+
+
+def mesh_arrays(points, mesh):
+    """
+    Converts the output of `load_stl` to shared vertices and faces.
+
+    Parameters:
+    points (ndarray): The vertices of the mesh.
+    mesh (trimesh.Trimesh or TriangleMesh or ndarray): The mesh object returned by `load_stl`, or raw
+    triangle records (whose corners are then merged with `merge_vertices`).
+
+    Returns:
+    tuple: A tuple containing the vertices (float32, shape (N, 3)) and the faces (int32, shape (M, 3)).
+    """
+    if isinstance(mesh, np.ndarray):
+        return merge_vertices(mesh["vertices"])
+    return np.ascontiguousarray(points, dtype=VERTEX_DTYPE), np.asarray(mesh.faces, dtype=FACE_DTYPE)
+
+
+def _read_index(store_dir):
+    index_path = Path(store_dir) / INDEX_NAME
+    if not index_path.exists():
+        return {"version": STORE_VERSION, "vertex_count": 0, "face_count": 0, "scans": []}
+    with open(index_path, encoding="utf-8") as f:
+        index = json.load(f)
+    if index.get("version") != STORE_VERSION:
+        raise ValueError(f"Unsupported dataset store version in {index_path}")
+    return index
+
+
+def _write_index(store_dir, index):
+    index_path = Path(store_dir) / INDEX_NAME
+    temp_path = index_path.with_name(index_path.name + ".tmp")
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(index, f, indent=1)
+    os.replace(temp_path, index_path)
+
+
+def _append_array(file_path, array, committed_count):
+    # Drops whatever an interrupted append left after the last committed row, then appends
+    with open(file_path, "ab") as f:
+        f.truncate(committed_count * array.itemsize * array.shape[1])
+        f.write(array.tobytes())
+
+
+def append_scans(store_dir, file_paths):
+    """
+    Appends processed scans to a packed dataset store, creating it if needed.
+
+    Parameters:
+    store_dir (Path or str): The folder of the store.
+    file_paths (iterable): The paths of the processed STL files to add.
+
+    Returns:
+    int: The number of scans added. Scans whose name is already in the store are skipped.
+
+    Explanation:
+    - The vertices and faces of each scan are appended to two flat binary files.
+    - The index (metadata and offsets of every scan) is rewritten atomically once, after the data of all
+      scans, so an interrupted append leaves the store as it was before the call.
+    """
+    store_dir = Path(store_dir)
+    os.makedirs(store_dir, exist_ok=True)
+    index = _read_index(store_dir)
+    known_names = {scan["name"] for scan in index["scans"]}
+
+    added = 0
+    for file_path in file_paths:
+        metadata = scan_metadata(file_path)
+        if metadata["name"] in known_names:
+            continue
+        vertices, faces = mesh_arrays(*load_stl(file_path))
+        _append_array(store_dir / VERTICES_NAME, vertices, index["vertex_count"])
+        _append_array(store_dir / FACES_NAME, faces, index["face_count"])
+        metadata.update(vertex_offset=index["vertex_count"], vertex_count=len(vertices),
+                        face_offset=index["face_count"], face_count=len(faces))
+        index["vertex_count"] += len(vertices)
+        index["face_count"] += len(faces)
+        index["scans"].append(metadata)
+        known_names.add(metadata["name"])
+        added += 1
+    if added:
+        _write_index(store_dir, index)
+    return added
+
+
+def pack_processed_folder(processed_folder, store_dir):
+    """
+    Adds every scan of the processed folder that is not in the store yet.
+
+    Parameters:
+    processed_folder (Path): The root of the processed folder, with the `YY.MM` subfolders.
+    store_dir (Path or str): The folder of the store.
+
+    Returns:
+    int: The number of scans added.
+    """
+    files = sorted(Path(processed_folder).glob("*/*.stl"), key=lambda file: file.name)
+    return append_scans(store_dir, files)
+
+
+def _open_array(file_path, dtype, rows):
+    if rows == 0:
+        return np.empty((0, 3), dtype=dtype)
+    return np.memmap(file_path, dtype=dtype, mode="r", shape=(rows, 3))
+
+
+def open_store(store_dir):
+    """
+    Opens a packed dataset store for reading.
+
+    Parameters:
+    store_dir (Path or str): The folder of the store.
+
+    Returns:
+    PackedDataset: The memory-mapped arrays and the scan metadata.
+
+    Explanation:
+    - Nothing is read until the arrays are accessed; the operating system pages in only the scans used.
+    - Rows beyond the counts in the index (from an interrupted append) are not mapped.
+    """
+    store_dir = Path(store_dir)
+    index = _read_index(store_dir)
+    scans = index["scans"]
+    vertex_offsets = np.array([scan["vertex_offset"] for scan in scans] + [index["vertex_count"]], dtype=np.int64)
+    face_offsets = np.array([scan["face_offset"] for scan in scans] + [index["face_count"]], dtype=np.int64)
+    return PackedDataset(_open_array(store_dir / VERTICES_NAME, VERTEX_DTYPE, index["vertex_count"]),
+                         _open_array(store_dir / FACES_NAME, FACE_DTYPE, index["face_count"]),
+                         scans, vertex_offsets, face_offsets)
+
+
+def get_scan(dataset, i):
+    """
+    Returns the arrays of one scan as zero-copy views.
+
+    Parameters:
+    dataset (PackedDataset): The store returned by `open_store`.
+    i (int): The position of the scan in `dataset.scans`.
+
+    Returns:
+    tuple: A tuple containing the vertices and the faces of the scan (indices into its own vertices).
+    """
+    vertices = dataset.vertices[dataset.vertex_offsets[i]:dataset.vertex_offsets[i + 1]]
+    faces = dataset.faces[dataset.face_offsets[i]:dataset.face_offsets[i + 1]]
+    return vertices, faces
+
+
+def find_scans(dataset, patient_id=None, file_type=None):
+    """
+    Finds the positions of the scans matching a patient ID and/or file type.
+    """
+    return [i for i, scan in enumerate(dataset.scans)
+            if (patient_id is None or scan["patient_id"] == patient_id)
+            and (file_type is None or scan["file_type"] == file_type)]
+
+
+def iter_batches(dataset, batch_size, indices=None, shuffle=False, seed=None):
+    """
+    Iterates over the scans in batches.
+
+    Parameters:
+    dataset (PackedDataset): The store returned by `open_store`.
+    batch_size (int): The number of scans per batch.
+    indices (list): The positions of the scans to use (e.g. from `find_scans`). Defaults to all of them.
+    shuffle (bool): Whether to visit the scans in random order.
+    seed (int): The seed of the random order.
+
+    Yields:
+    list: A list of (metadata, vertices, faces) tuples, with the arrays as zero-copy views.
+    """
+    indices = np.arange(len(dataset.scans)) if indices is None else np.asarray(indices)
+    if shuffle:
+        indices = np.random.default_rng(seed).permutation(indices)
+    for start in range(0, len(indices), batch_size):
+        yield [(dataset.scans[i], *get_scan(dataset, i)) for i in indices[start:start + batch_size]]
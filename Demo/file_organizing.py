@@ -25,6 +25,20 @@ def extract_info(file):
     year = int(parts[2])
     return id_original, month, year
 
+def sort_by_date(files):
+    """
+    Sorts files by the date and ID in their filenames, parsing each filename once.
+
+    Parameters:
+    files (iterable): The file path objects.
+
+    Returns:
+    list: A list of tuples containing the file and its (original ID, month, year), sorted by year, month and ID.
+    """
+    parsed = [(file, extract_info(file)) for file in files]
+    parsed.sort(key=lambda item: (item[1][2], item[1][1], item[1][0]))
+    return parsed
+
 def rename_files(folder_path, start_index):
     """
     Renames files in the folder based on a new naming convention.
@@ -41,12 +55,10 @@ def rename_files(folder_path, start_index):
     - Sorts the files based on the date information extracted from their filenames.
     - Renames each file with a new naming convention and collects the old and new file paths.
     """
-    files = list(folder_path.glob("*.stl"))
-    sorted_files = sorted(files, key=lambda f: (extract_info(f)[2], extract_info(f)[1], extract_info(f)[0]))
+    sorted_files = sort_by_date(folder_path.glob("*.stl"))
 
     renamed_files = []
-    for i, file in enumerate(sorted_files, start=start_index):
-        id_original, month, year = extract_info(file)
+    for i, (file, (id_original, month, year)) in enumerate(sorted_files, start=start_index):
         new_filename = f"{i:04d}_{id_original}_{month:02d}_{year:02d}.stl"
         new_filepath = folder_path / new_filename
         renamed_files.append((file, new_filepath))
@@ -60,11 +72,16 @@ def organize_files(renamed_files, folder_path):
     renamed_files (list): A list of tuples containing the old and new file paths.
     folder_path (Path): The path to the folder containing the files.
 
+    Returns:
+    list: A list of the final file paths, in the same order as `renamed_files`.
+
     Explanation:
     - Extracts the month and year from the new filename.
     - Creates a subfolder based on the month and year.
     - Moves the renamed file to the subfolder.
+    - Files saved next to it with the same name and another suffix (e.g. `.lod.npz`) are moved and renamed too.
     """
+    final_filepaths = []
     for old_file, new_filepath in renamed_files:
         # Extract month and year from the new filename
         new_filename = new_filepath.name
@@ -78,4 +95,9 @@ def organize_files(renamed_files, folder_path):
 
         # Move the renamed file to the subfolder
         final_filepath = subfolder / new_filename
-        shutil.move(str(old_file), final_filepath)
\ No newline at end of file
+        shutil.move(str(old_file), final_filepath)
+        for sidecar in old_file.parent.glob(f"{old_file.stem}.*"):
+            sidecar_suffix = sidecar.name[len(old_file.stem):]
+            shutil.move(str(sidecar), subfolder / (new_filepath.stem + sidecar_suffix))
+        final_filepaths.append(final_filepath)
+    return final_filepaths
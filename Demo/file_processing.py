@@ -1,6 +1,23 @@
+from collections import namedtuple
+from pathlib import Path
+
 import numpy as np
-import trimesh
-from sklearn.decomposition import PCA
+
+from metrics import count, count_file_bytes, stage
+from stl_io import (STL_RECORD_DTYPE, TriangleMesh, is_binary_stl, iter_binary_stl_chunks, merge_vertices,
+                    read_binary_stl, triangle_normals, write_binary_stl, write_binary_stl_header)
+
+# Version of the alignment pipeline, stored with every processed scan; bump it when the output changes
+PIPELINE_VERSION = 3
+
+# Number of points handled at once when scanning or transforming a point array
+CHUNK_SIZE = 1 << 20
+
+# Suffix of the level-of-detail point clouds stored next to a processed STL file
+LOD_SUFFIX = ".lod.npz"
+
+# Principal axes of a point cloud, with the same attribute names as `sklearn.decomposition.PCA`
+PrincipalAxes = namedtuple("PrincipalAxes", ["mean_", "components_", "explained_variance_"])
 
 
 def load_stl(file_path):
@@ -14,14 +31,114 @@ def load_stl(file_path):
     tuple: A tuple containing the points (vertices) of the mesh and the mesh object itself.
 
     Explanation:
-    - Uses the `trimesh` library to load the STL file.
+    - Binary STL files are memory-mapped. The corners of the triangle records are merged into shared
+      vertices with `merge_vertices`, as `trimesh` does, so every vertex counts once in the PCA, octree
+      and spatial index. The points are a new writable float32 array and the mesh is a `TriangleMesh`.
+    - ASCII STL and other formats fall back to the `trimesh` library.
     - Extracts the vertices (points) from the mesh.
     """
+    if is_binary_stl(file_path):
+        records = read_binary_stl(file_path)
+        points, faces = merge_vertices(records["vertices"])
+        return points, TriangleMesh(faces, records)
+
+    # trimesh is slow to import and only needed for these files
+    import trimesh
     mesh = trimesh.load(file_path)
     points = mesh.vertices
     return points, mesh
 
 
+def chunk_moments(chunk):
+    """
+    Computes the count, mean and scatter matrix of a chunk of points.
+
+    Parameters:
+    chunk (ndarray): A chunk of vertices, with shape (N, 3).
+
+    Returns:
+    tuple: A tuple containing the count, the mean (3,) and the scatter matrix (3, 3) of the chunk.
+
+    Explanation:
+    - The scatter matrix is the sum of the outer products of the centered points, computed in float64.
+    """
+    chunk = np.asarray(chunk, dtype=np.float64)
+    mean = chunk.mean(axis=0)
+    centered = chunk - mean
+    return len(chunk), mean, centered.T @ centered
+
+
+def merge_moments(first, second):
+    """
+    Merges the moments of two sets of points.
+
+    Parameters:
+    first (tuple): The count, mean and scatter matrix of the first set, as returned by `chunk_moments`.
+    second (tuple): The count, mean and scatter matrix of the second set.
+
+    Returns:
+    tuple: The count, mean and scatter matrix of the union of both sets.
+
+    Explanation:
+    - Uses the pairwise update of Chan et al., which stays accurate for scans far from the origin
+      because only centered quantities are added.
+    """
+    count_a, mean_a, scatter_a = first
+    count_b, mean_b, scatter_b = second
+    count = count_a + count_b
+    if count_a == 0 or count_b == 0:
+        return first if count_b == 0 else second
+    delta = mean_b - mean_a
+    mean = mean_a + delta * (count_b / count)
+    scatter = scatter_a + scatter_b + np.outer(delta, delta) * (count_a * count_b / count)
+    return count, mean, scatter
+
+
+def point_moments(points, chunk_size=CHUNK_SIZE):
+    """
+    Computes the mean and the covariance matrix of the points in a single pass.
+
+    Parameters:
+    points (ndarray): The vertices of the mesh.
+    chunk_size (int): The number of points accumulated at once.
+
+    Returns:
+    tuple: A tuple containing the mean (3,) and the sample covariance matrix (3, 3).
+
+    Explanation:
+    - The points are handled chunk by chunk in float64, so no N x 3 temporaries are created.
+    - The moments of the chunks are combined with `merge_moments`.
+    """
+    moments = (0, np.zeros(3), np.zeros((3, 3)))
+    for start in range(0, len(points), chunk_size):
+        moments = merge_moments(moments, chunk_moments(points[start:start + chunk_size]))
+    count, mean, scatter = moments
+    return mean, scatter / max(count - 1, 1)
+
+
+def principal_axes(mean, covariance):
+    """
+    Computes the principal axes from the mean and covariance matrix of the points.
+
+    Parameters:
+    mean (ndarray): The mean of the points.
+    covariance (ndarray): The 3x3 covariance matrix of the points.
+
+    Returns:
+    PrincipalAxes: The mean, the components (one per row, main axis first) and their variances.
+
+    Explanation:
+    - The components are the eigenvectors of the 3x3 covariance matrix, sorted by decreasing variance.
+    - Each component is signed so that its largest absolute entry is positive,
+      which matches the convention of `sklearn.decomposition.PCA`.
+    """
+    variances, vectors = np.linalg.eigh(covariance)
+    components = vectors[:, ::-1].T
+    signs = np.sign(components[np.arange(3), np.argmax(np.abs(components), axis=1)])
+    components = components * signs[:, np.newaxis]
+    return PrincipalAxes(mean, components, variances[::-1])
+
+
 def apply_pca(points):
     """
     Applies Principal Component Analysis (PCA) to the points.
@@ -30,16 +147,13 @@ def apply_pca(points):
     points (ndarray): The vertices of the mesh.
 
     Returns:
-    PCA: The fitted PCA object.
+    PrincipalAxes: The mean, the components (one per row, main axis first) and their variances.
 
     Explanation:
     - PCA is used to identify the main axes of variation in the data.
-    - The `sklearn.decomposition.PCA` class is used to perform PCA.
-    - The number of components is set to 3 to match the 3D nature of the points.
+    - The mean and covariance are computed with `point_moments`, the axes with `principal_axes`.
     """
-    pca = PCA(n_components=3)
-    pca.fit(points)
-    return pca
+    return principal_axes(*point_moments(points))
 
 
 def align_with_axis(points, pca):
@@ -48,7 +162,7 @@ def align_with_axis(points, pca):
 
     Parameters:
     points (ndarray): The vertices of the mesh.
-    pca (PCA): The fitted PCA object.
+    pca (PrincipalAxes): The principal axes returned by `apply_pca`.
 
     Returns:
     ndarray: The aligned points.
@@ -81,6 +195,8 @@ def rotation_matrix_from_vectors(vec1, vec2):
     - Uses the cross product to find the axis of rotation.
     - Uses the dot product to find the cosine of the angle of rotation.
     - Constructs the rotation matrix using the Rodrigues' rotation formula.
+    - If the vectors are already parallel, the identity is returned. If they are antiparallel,
+      a half turn about an axis perpendicular to vec1 is returned.
     """
     """
     Rodrigues' rotation formula is a method for rotating a vector in three-dimensional space. It provides a way to compute the rotation matrix given an axis of rotation and an angle. The formula is particularly useful for converting between axis-angle representation and rotation matrices.  Given a unit vector k (the axis of rotation) and an angle θ (the angle of rotation), the rotation matrix R can be computed as:  [ R = I + \sin(\theta) \cdot K + (1 - \cos(\theta)) \cdot K^2 ]  where:  
@@ -96,6 +212,14 @@ def rotation_matrix_from_vectors(vec1, vec2):
     v = np.cross(a, b)
     c = np.dot(a, b)
     s = np.linalg.norm(v)
+    if s < 1e-12:
+        if c > 0:
+            return np.eye(3)
+        # Half turn about any axis perpendicular to a
+        helper = np.eye(3)[np.argmin(np.abs(a))]
+        k = np.cross(a, helper)
+        k /= np.linalg.norm(k)
+        return 2.0 * np.outer(k, k) - np.eye(3)
     kmat = np.array([[0, -v[2], v[1]], [v[2], 0, -v[0]], [-v[1], v[0], 0]])
     rotation_matrix = np.eye(3) + kmat + kmat.dot(kmat) * ((1 - c) / (s ** 2))
     return rotation_matrix
@@ -123,40 +247,303 @@ def move_center_to_origin(points):
     return centered_points
 
 
+def alignment_rotation(pca):
+    """
+    Computes the rotation that aligns the main axis of the points with the Y-axis.
+
+    Parameters:
+    pca (PrincipalAxes): The principal axes returned by `apply_pca`.
+
+    Returns:
+    ndarray: The 3x3 rotation matrix.
+    """
+    return rotation_matrix_from_vectors(pca.components_[0], np.array([0, 1, 0]))
+
+
+def centering_matrix(rotation, bbox_min, bbox_max):
+    """
+    Builds the affine transform that rotates the points and moves their bounding box center to the origin.
+
+    Parameters:
+    rotation (ndarray): The 3x3 rotation matrix.
+    bbox_min (ndarray): The minimum corner of the bounding box of the rotated points.
+    bbox_max (ndarray): The maximum corner of the bounding box of the rotated points.
+
+    Returns:
+    ndarray: The 4x4 affine matrix.
+    """
+    matrix = np.eye(4)
+    matrix[:3, :3] = rotation
+    matrix[:3, 3] = -(bbox_max + bbox_min) / 2.0
+    return matrix
+
+
+def alignment_matrix(points, pca=None, chunk_size=CHUNK_SIZE):
+    """
+    Computes the affine transform that aligns the points with the Y-axis and centers them.
+
+    Parameters:
+    points (ndarray): The vertices of the mesh.
+    pca (PrincipalAxes): The principal axes of the points. Computed with `apply_pca` if not given.
+    chunk_size (int): The number of points rotated at once to find the bounding box.
+
+    Returns:
+    ndarray: A 4x4 affine matrix combining `align_with_axis` and `move_center_to_origin`.
+
+    Explanation:
+    - The rotation about the mean followed by the recentering reduces to a rotation R and
+      a translation t = -center(bbox(R p)), because the mean cancels out.
+    - The bounding box of the rotated points is found chunk by chunk without modifying the points.
+    """
+    if pca is None:
+        pca = apply_pca(points)
+    rotation = alignment_rotation(pca)
+
+    bbox_min = np.full(3, np.inf)
+    bbox_max = np.full(3, -np.inf)
+    for start in range(0, len(points), chunk_size):
+        rotated = points[start:start + chunk_size] @ rotation.T
+        bbox_min = np.minimum(bbox_min, rotated.min(axis=0))
+        bbox_max = np.maximum(bbox_max, rotated.max(axis=0))
+    return centering_matrix(rotation, bbox_min, bbox_max)
+
+
+def apply_transform(points, matrix, chunk_size=CHUNK_SIZE):
+    """
+    Applies a 4x4 affine transform to the points in place.
+
+    Parameters:
+    points (ndarray): The vertices of the mesh. Must be writable.
+    matrix (ndarray): The 4x4 affine matrix.
+    chunk_size (int): The number of points transformed at once.
+
+    Returns:
+    ndarray: The same array, holding the transformed points.
+    """
+    rotation = matrix[:3, :3].T
+    translation = matrix[:3, 3]
+    for start in range(0, len(points), chunk_size):
+        chunk = points[start:start + chunk_size]
+        chunk[...] = chunk @ rotation + translation
+    return points
+
+
+def voxel_downsample(points, voxel_size, origin, weights=None):
+    """
+    Replaces the points in each cell of a voxel grid with their centroid.
+
+    Parameters:
+    points (ndarray): The points, with shape (N, 3).
+    voxel_size (float): The side length of the voxels.
+    origin (ndarray): The corner of the voxel grid.
+    weights (ndarray): The optional weight of each point (e.g. the number of points it already stands for).
+
+    Returns:
+    tuple: A tuple containing the centroids (M, 3) and the total weight of each voxel (M,).
+
+    Explanation:
+    - The voxel of every point is computed at once and turned into a single integer key.
+    - The points are grouped by key with `np.unique`, and the sums per voxel are taken with `np.bincount`.
+    """
+    cells = np.floor((points - origin) / voxel_size).astype(np.int64)
+    keys = np.ravel_multi_index(cells.T, cells.max(axis=0) + 1)
+    _, inverse = np.unique(keys, return_inverse=True)
+    if weights is None:
+        weights = np.ones(len(points))
+    totals = np.bincount(inverse, weights=weights)
+    centroids = np.stack([np.bincount(inverse, weights=points[:, axis] * weights) for axis in range(3)], axis=1)
+    return centroids / totals[:, np.newaxis], totals
+
+
+def build_lod(points, voxel_size, levels=4):
+    """
+    Builds a pyramid of downsampled point clouds, with the voxel size doubling at each level.
+
+    Parameters:
+    points (ndarray): The aligned vertices of the mesh.
+    voxel_size (float): The voxel size of the finest level, in the units of the scan.
+    levels (int): The number of levels.
+
+    Returns:
+    list: A list of tuples containing the voxel size, the centroids and the point counts of each level.
+
+    Explanation:
+    - All levels share the grid origin, so every coarse voxel is made of eight finer ones.
+    - Each level is computed from the previous one, weighting the centroids by their point counts,
+      which gives the same result as downsampling the full cloud.
+    """
+    origin = points.min(axis=0)
+    pyramid = []
+    level_points, level_weights = np.asarray(points, dtype=np.float64), None
+    for level in range(levels):
+        size = voxel_size * 2 ** level
+        level_points, level_weights = voxel_downsample(level_points, size, origin, level_weights)
+        pyramid.append((size, level_points, level_weights))
+    return pyramid
+
+
+def lod_path(stl_path):
+    """
+    Returns the path of the level-of-detail file stored next to a processed STL file.
+    """
+    stl_path = Path(stl_path)
+    return stl_path.with_name(stl_path.stem + LOD_SUFFIX)
+
+
+def save_lod(pyramid, file_path):
+    """
+    Saves a level-of-detail pyramid to an uncompressed NumPy archive.
+
+    Parameters:
+    pyramid (list): The pyramid returned by `build_lod`.
+    file_path (Path or str): The path of the archive.
+
+    Explanation:
+    - The centroids are stored as float32 and the counts as uint32, one array per level,
+      so a coarse level can be loaded without reading the finer ones.
+    """
+    arrays = {"voxel_sizes": np.array([size for size, _, _ in pyramid])}
+    for level, (_, centroids, counts) in enumerate(pyramid):
+        arrays[f"points_{level}"] = centroids.astype(np.float32)
+        arrays[f"counts_{level}"] = counts.astype(np.uint32)
+    with open(file_path, "wb") as f:
+        np.savez(f, **arrays)
+
+
+def load_lod(file_path, level):
+    """
+    Loads one level of a level-of-detail file.
+
+    Parameters:
+    file_path (Path or str): The path of the file written by `save_lod` (see `lod_path`).
+    level (int): The level to load; 0 is the finest. Negative values count from the coarsest.
+
+    Returns:
+    tuple: A tuple containing the voxel size, the points and the point counts of the level.
+    """
+    with np.load(file_path) as data:
+        voxel_sizes = data["voxel_sizes"]
+        level = range(len(voxel_sizes))[level]
+        return float(voxel_sizes[level]), data[f"points_{level}"], data[f"counts_{level}"]
+
+
 def save_aligned_stl(points, mesh, file_path):
     """
     Saves the aligned points back to an STL file.
 
     Parameters:
     points (ndarray): The aligned vertices of the mesh.
-    mesh (trimesh.Trimesh): The mesh object.
+    mesh (trimesh.Trimesh or TriangleMesh): The mesh object returned by `load_stl`.
     file_path (Path or str): The path to save the STL file.
 
     Explanation:
-    - Updates the vertices of the mesh with the aligned points.
+    - For meshes loaded from binary STL, the triangles are gathered from the points straight into a
+      new binary STL file and the normals are recomputed in bulk.
+    - Otherwise, updates the vertices of the mesh with the aligned points.
     - Uses the `trimesh` library to export the mesh to an STL file.
     """
+    if isinstance(mesh, TriangleMesh):
+        if str(file_path).lower().endswith(".stl"):
+            write_binary_stl(file_path, points, mesh.records["attributes"], faces=mesh.faces)
+            return
+        import trimesh
+        mesh = trimesh.Trimesh(vertices=points, faces=mesh.faces, process=False)
+
     mesh.vertices = points
     mesh.export(file_path)
 
 
-def process_file(input_path, output_path):
+def process_file(input_path, output_path, dtype=None, lod_voxel_size=None, lod_levels=4):
     """
     Processes an STL file by loading, aligning, centering, and saving it.
 
     Parameters:
     input_path (Path or str): The path to the input STL file.
     output_path (Path or str): The path to save the processed STL file.
+    dtype (type): The optional floating point type used to store the points (e.g. `np.float32`).
+    lod_voxel_size (float): If given, the voxel size of the finest level-of-detail point cloud.
+    lod_levels (int): The number of level-of-detail point clouds.
+
+    Returns:
+    ndarray: The aligned and centered points, e.g. for `octree.build_octree`.
 
     Explanation:
     - Loads the STL file and extracts the points.
     - Applies PCA to find the main axes of variation.
-    - Aligns the points with the Y-axis.
-    - Moves the center of the points to the origin.
+    - Combines the alignment with the Y-axis and the move to the origin into one affine transform.
+    - Applies the transform once, in place.
     - Saves the processed points back to an STL file.
+    - Optionally downsamples the aligned points into a level-of-detail pyramid saved next to it.
+    """
+    with stage("load"):
+        points, mesh = load_stl(input_path)
+        if dtype is not None:
+            points = points.astype(dtype, copy=False)
+        if not points.flags.writeable:
+            points = points.copy()
+    count_file_bytes("bytes_read", input_path)
+    count("vertices", len(points))
+    with stage("pca"):
+        pca = apply_pca(points)
+    with stage("transform"):
+        matrix = alignment_matrix(points, pca)
+        apply_transform(points, matrix)
+    with stage("save"):
+        save_aligned_stl(points, mesh, output_path)
+    count_file_bytes("bytes_written", output_path)
+    if lod_voxel_size:
+        with stage("lod"):
+            save_lod(build_lod(points, lod_voxel_size, lod_levels), lod_path(output_path))
+        count_file_bytes("bytes_written", lod_path(output_path))
+    return points
+
+
+def process_file_chunked(input_path, output_path, chunk_size=CHUNK_SIZE):
+    """
+    Processes a binary STL file like `process_file`, without loading it into memory.
+
+    Parameters:
+    input_path (Path or str): The path to the input STL file.
+    output_path (Path or str): The path to save the processed STL file.
+    chunk_size (int): The number of triangles read at once. Peak memory is proportional to it.
+
+    Explanation:
+    - First pass: the mean and covariance are accumulated chunk by chunk with `merge_moments`.
+    - Second pass: the bounding box of the rotated points is accumulated. It depends on the rotation,
+      so it cannot be taken from the first pass.
+    - Third pass: every chunk is transformed, its normals are recomputed and it is appended to the output.
+    - The vertices are not merged, so each one is weighted by the number of triangles that use it. On meshes
+      of even density the result matches `process_file` to floating point tolerance; otherwise the rotation
+      can differ slightly. Other formats fall back to `process_file`.
     """
-    points, mesh = load_stl(input_path)
-    pca = apply_pca(points)
-    aligned_points = align_with_axis(points, pca)
-    centered_points = move_center_to_origin(aligned_points)
-    save_aligned_stl(centered_points, mesh, output_path)
+    if not is_binary_stl(input_path):
+        process_file(input_path, output_path)
+        return
+
+    with stage("pca"):
+        moments = (0, np.zeros(3), np.zeros((3, 3)))
+        for records in iter_binary_stl_chunks(input_path, chunk_size):
+            moments = merge_moments(moments, chunk_moments(records["vertices"].reshape(-1, 3)))
+        n_points, mean, scatter = moments
+        rotation = alignment_rotation(principal_axes(mean, scatter / max(n_points - 1, 1)))
+    count_file_bytes("bytes_read", input_path)
+    count("vertices", n_points)
+
+    with stage("bounds"):
+        bbox_min = np.full(3, np.inf)
+        bbox_max = np.full(3, -np.inf)
+        for records in iter_binary_stl_chunks(input_path, chunk_size):
+            rotated = records["vertices"].reshape(-1, 3) @ rotation.T
+            bbox_min = np.minimum(bbox_min, rotated.min(axis=0))
+            bbox_max = np.maximum(bbox_max, rotated.max(axis=0))
+        matrix = centering_matrix(rotation, bbox_min, bbox_max)
+
+    with stage("transform_save"), open(output_path, "wb") as f:
+        write_binary_stl_header(f, n_points // 3)
+        for records in iter_binary_stl_chunks(input_path, chunk_size):
+            output = np.empty(len(records), dtype=STL_RECORD_DTYPE)
+            output["vertices"] = apply_transform(records["vertices"].reshape(-1, 3), matrix).reshape(-1, 3, 3)
+            output["normal"] = triangle_normals(output["vertices"])
+            output["attributes"] = records["attributes"]
+            f.write(output.tobytes())
+    count_file_bytes("bytes_written", output_path)
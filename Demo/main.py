@@ -1,33 +1,95 @@
+import sys
+from pathlib import Path
+
+# The instrumentation and dedup modules live in the repository root
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
 from file_processing import *
 from file_organizing import *
+import instrumentation
+from batch_processing import process_batch
+from dataset_store import pack_processed_folder
+from manifest import find_unprocessed, next_index, open_manifest, record_outputs
 
 # To use this script, define the paths where your files are
 original_folder = Path("C:/Users/Danya/Downloads/KI-Assistenz/KI-Assistenz_Datenbank_Initial")
 processed_folder = Path("C:/Users/Danya/Downloads/KI-Assistenz/KI-Assistenz_Datenbank_Processed")
 
-# Ensure the processed folder exists
-os.makedirs(processed_folder, exist_ok=True)
-
-# Extract and order files by date
-files = list(original_folder.glob("*.stl"))
-sorted_files = sorted(files, key=lambda f: (extract_info(f)[2], extract_info(f)[1], extract_info(f)[0]))
-
-# Determine the starting index for numbering in the processed folder
-existing_files = list(processed_folder.glob("*.stl"))
-if existing_files:
-    max_number = max(int(file.stem.split('_')[0]) for file in existing_files)
-    start_index = max_number + 1
-else:
-    start_index = 0
-
-# Process each file, save it to the processed folder, and rename
-renamed_files = []
-for file in sorted_files:
-    processed_file_path = processed_folder / file.name
-    print(file.name)
-    process_file(file, processed_file_path)
-    renamed_files.append((file, processed_file_path))
-
-# Organize the processed files
-renamed_files = rename_files(processed_folder, start_index)
-organize_files(renamed_files, processed_folder)
\ No newline at end of file
+# Number of worker processes used to align the scans (None uses all CPUs)
+workers = None
+
+# Align the scans out of core, with memory bounded by the chunk size (for scans larger than RAM)
+chunked = False
+
+# Finest voxel size (in mm) of the level-of-detail point clouds saved next to each scan (None disables them)
+lod_voxel_size = None
+
+# Folder of the packed dataset store updated with the new scans after each run (None disables it)
+dataset_store = None
+
+
+def run_pipeline(original_folder, processed_folder, workers=None, chunked=False, lod_voxel_size=None,
+                 dataset_store=None):
+    """
+    Aligns the new scans of the original folder and files them in the processed folder.
+
+    Parameters:
+    original_folder (Path): The folder with the original STL files.
+    processed_folder (Path): The folder where the processed files are organized.
+    workers (int): The number of worker processes (None uses all CPUs).
+    chunked (bool): Whether to align the scans out of core.
+    lod_voxel_size (float): If given, the finest voxel size of the level-of-detail point clouds.
+    dataset_store (Path): If given, the folder of the packed dataset store updated with the new scans.
+
+    Returns:
+    list: The `BatchResult` of every scan that was processed.
+    """
+    original_folder = Path(original_folder)
+    processed_folder = Path(processed_folder)
+
+    # Ensure the processed folder exists
+    os.makedirs(processed_folder, exist_ok=True)
+
+    manifest = open_manifest(processed_folder)
+
+    # Extract and order files by date
+    files = list(original_folder.glob("*.stl"))
+    sorted_files = [file for file, _ in sort_by_date(files)]
+
+    # Skip the files that are already in the manifest and unchanged
+    pending = find_unprocessed(manifest, sorted_files)
+    print(f"{len(pending)} of {len(sorted_files)} files need processing")
+
+    # Determine the starting index for numbering in the processed folder
+    start_index = next_index(manifest, processed_folder)
+
+    # Process all files in parallel and save them to the processed folder
+    results = process_batch([file for file, _ in pending], processed_folder, workers=workers, chunked=chunked,
+                            lod_voxel_size=lod_voxel_size)
+
+    # Organize the processed files
+    renamed_files = rename_files(processed_folder, start_index)
+    final_filepaths = organize_files(renamed_files, processed_folder)
+
+    # Record the new outputs so they are skipped next time
+    hashes = {file.name: (file, content_hash) for file, content_hash in pending}
+    entries = []
+    for i, ((processed_file, _), final_filepath) in enumerate(zip(renamed_files, final_filepaths), start=start_index):
+        if processed_file.name in hashes:
+            input_path, content_hash = hashes[processed_file.name]
+            entries.append((input_path, content_hash, final_filepath, i))
+    record_outputs(manifest, entries)
+    manifest.close()
+
+    # Append the new scans to the packed store used by training and analysis jobs
+    if dataset_store is not None:
+        added = pack_processed_folder(processed_folder, dataset_store)
+        print(f"{added} scans added to the dataset store")
+    return results
+
+
+if __name__ == "__main__":
+    # Set PIPELINE_METRICS (and optionally PIPELINE_PROFILE) to collect per-stage metrics
+    instrumentation.enable_from_environment()
+    run_pipeline(original_folder, processed_folder, workers, chunked, lod_voxel_size, dataset_store)
+    instrumentation.finish()
@@ -0,0 +1,144 @@
+import glob
+import os
+import sqlite3
+from pathlib import Path
+
+# dedup lives in the repository root, which the entry points (main.py, cli.py, watch_folder.py) put on the path
+from dedup import hash_file
+from file_processing import PIPELINE_VERSION
+
+
+MANIFEST_NAME = "manifest.sqlite"
+
+
+def open_manifest(processed_folder):
+    """
+    Opens (and creates if needed) the manifest of processed scans.
+
+    Parameters:
+    processed_folder (Path): The root of the processed folder, where the manifest is stored.
+
+    Returns:
+    sqlite3.Connection: The connection to the manifest database.
+
+    Explanation:
+    - Each row maps the content hash of an input scan to its size, mtime, output path,
+      assigned index and the pipeline version that produced it.
+    - The input path is indexed too, so unchanged inputs can be found without hashing them.
+    """
+    connection = sqlite3.connect(str(Path(processed_folder) / MANIFEST_NAME))
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS scans ("
+        " content_hash TEXT PRIMARY KEY,"
+        " input_path TEXT NOT NULL,"
+        " size INTEGER NOT NULL,"
+        " mtime_ns INTEGER NOT NULL,"
+        " output_path TEXT NOT NULL,"
+        " file_index INTEGER NOT NULL,"
+        " pipeline_version INTEGER NOT NULL)"
+    )
+    connection.execute("CREATE INDEX IF NOT EXISTS scans_input_path ON scans (input_path)")
+    connection.commit()
+    return connection
+
+
+def find_unprocessed(connection, files):
+    """
+    Selects the input scans that still have to be processed.
+
+    Parameters:
+    connection (sqlite3.Connection): The manifest returned by `open_manifest`.
+    files (list): The paths of the input STL files.
+
+    Returns:
+    list: A list of tuples containing the path and the content hash of every new or modified scan,
+    in the same order as `files`.
+
+    Explanation:
+    - If the path, size and mtime match a manifest entry of the current pipeline version,
+      the file is skipped without being read.
+    - Otherwise the content is hashed. A known hash (e.g. a touched or moved file) is skipped
+      and its entry is updated so the next run takes the fast path.
+    """
+    pending = []
+    for file in files:
+        file = Path(file)
+        stat = os.stat(file)
+        row = connection.execute(
+            "SELECT 1 FROM scans WHERE input_path = ? AND size = ? AND mtime_ns = ? AND pipeline_version = ?",
+            (str(file), stat.st_size, stat.st_mtime_ns, PIPELINE_VERSION),
+        ).fetchone()
+        if row:
+            continue
+
+        content_hash = hash_file(file)
+        row = connection.execute(
+            "SELECT 1 FROM scans WHERE content_hash = ? AND pipeline_version = ?",
+            (content_hash, PIPELINE_VERSION),
+        ).fetchone()
+        if row:
+            connection.execute(
+                "UPDATE scans SET input_path = ?, size = ?, mtime_ns = ? WHERE content_hash = ?",
+                (str(file), stat.st_size, stat.st_mtime_ns, content_hash),
+            )
+            continue
+        pending.append((file, content_hash))
+    connection.commit()
+    return pending
+
+
+def next_index(connection, processed_folder):
+    """
+    Determines the starting index for numbering new files in the processed folder.
+
+    Parameters:
+    connection (sqlite3.Connection): The manifest returned by `open_manifest`.
+    processed_folder (Path): The root of the processed folder.
+
+    Returns:
+    int: One more than the highest index assigned so far, or 0 for an empty folder.
+
+    Explanation:
+    - Uses the highest index recorded in the manifest.
+    - Without manifest entries (e.g. an archive processed before the manifest existed), the
+      numbered files are searched in the processed folder and all its `YY.MM` subfolders.
+    """
+    max_number = connection.execute("SELECT MAX(file_index) FROM scans").fetchone()[0]
+    if max_number is None:
+        numbers = [int(file.stem.split('_')[0]) for file in Path(processed_folder).rglob("*.stl")
+                   if file.stem.split('_')[0].isdigit()]
+        max_number = max(numbers, default=-1)
+    return max_number + 1
+
+
+def remove_output(output_path):
+    """
+    Deletes a processed STL file and the files stored next to it (e.g. its level-of-detail point clouds).
+    """
+    output_path = Path(output_path)
+    for file in output_path.parent.glob(glob.escape(output_path.stem) + ".*"):
+        file.unlink()
+
+
+def record_outputs(connection, entries):
+    """
+    Stores the outputs of newly processed scans in the manifest.
+
+    Parameters:
+    connection (sqlite3.Connection): The manifest returned by `open_manifest`.
+    entries (list): A list of tuples containing the input path, content hash, output path and index.
+
+    Explanation:
+    - A scan reprocessed after a `PIPELINE_VERSION` bump gets a new index and output path. The output
+      recorded for the older version is deleted, so the scan is not in the processed folder twice.
+    """
+    rows = []
+    for input_path, content_hash, output_path, file_index in entries:
+        stat = os.stat(input_path)
+        row = connection.execute("SELECT output_path FROM scans WHERE content_hash = ?", (content_hash,)).fetchone()
+        if row and Path(row[0]) != Path(output_path):
+            remove_output(row[0])
+        rows.append((content_hash, str(input_path), stat.st_size, stat.st_mtime_ns,
+                     str(output_path), file_index, PIPELINE_VERSION))
+    connection.executemany("INSERT OR REPLACE INTO scans VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+    connection.commit()
@@ -0,0 +1,32 @@
+import contextlib
+
+# The per-stage metrics of the Demo modules are collected by the instrumentation module of the repository root,
+# which the entry points (main.py, cli.py, watch_folder.py) put on the path. When a Demo module is used on its
+# own, the functions below do nothing and the scans are processed without metrics.
+try:
+    from instrumentation import add_record, count, count_file_bytes, enable, file_metrics, is_enabled, reset, stage
+except ImportError:
+    def add_record(record):
+        pass
+
+    def count(name, amount=1):
+        pass
+
+    def count_file_bytes(name, file_path):
+        pass
+
+    def enable(metrics_path=None, profile=False, trace_memory=False):
+        pass
+
+    @contextlib.contextmanager
+    def file_metrics(label):
+        yield None
+
+    def is_enabled():
+        return False
+
+    def reset():
+        pass
+
+    def stage(name):
+        return contextlib.nullcontext()
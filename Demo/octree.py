@@ -0,0 +1,281 @@
+from collections import namedtuple
+from pathlib import Path
+
+import numpy as np
+
+from file_processing import load_stl
+
+
+# Bits per axis that fit in a 64-bit Morton code
+MAX_DEPTH = 21
+
+# Sorted occupied leaf cells of an octree, as Morton codes at `max_depth`, with the number of points in each
+Octree = namedtuple("Octree", ["codes", "counts", "origin", "size", "max_depth"])
+
+# Offsets to the 26 cells around a cell
+NEIGHBOUR_OFFSETS = np.array([(x, y, z) for x in (-1, 0, 1) for y in (-1, 0, 1) for z in (-1, 0, 1)
+                              if (x, y, z) != (0, 0, 0)], dtype=np.int64)
+
+
+def _spread_bits(values):
+    """
+    Inserts two zero bits between each of the lower 21 bits of the values.
+    """
+    x = values.astype(np.uint64) & np.uint64(0x1fffff)
+    x = (x | x << np.uint64(32)) & np.uint64(0x1f00000000ffff)
+    x = (x | x << np.uint64(16)) & np.uint64(0x1f0000ff0000ff)
+    x = (x | x << np.uint64(8)) & np.uint64(0x100f00f00f00f00f)
+    x = (x | x << np.uint64(4)) & np.uint64(0x10c30c30c30c30c3)
+    x = (x | x << np.uint64(2)) & np.uint64(0x1249249249249249)
+    return x
+
+
+def _compact_bits(codes):
+    """
+    Inverse of `_spread_bits`: keeps every third bit of the codes.
+    """
+    x = codes & np.uint64(0x1249249249249249)
+    x = (x ^ (x >> np.uint64(2))) & np.uint64(0x10c30c30c30c30c3)
+    x = (x ^ (x >> np.uint64(4))) & np.uint64(0x100f00f00f00f00f)
+    x = (x ^ (x >> np.uint64(8))) & np.uint64(0x1f0000ff0000ff)
+    x = (x ^ (x >> np.uint64(16))) & np.uint64(0x1f00000000ffff)
+    x = (x ^ (x >> np.uint64(32))) & np.uint64(0x1fffff)
+    return x.astype(np.int64)
+
+
+def morton_encode(cells):
+    """
+    Computes the 3D Morton codes of integer cell coordinates.
+
+    Parameters:
+    cells (ndarray): The integer cell coordinates, with shape (N, 3). Each must be below 2**21.
+
+    Returns:
+    ndarray: The Morton codes (uint64), with shape (N,).
+
+    Explanation:
+    - The bits of x, y and z are interleaved, so cells that are close in space get close codes.
+    - The code of the parent cell one level up is the code shifted right by 3 bits.
+    """
+    return (_spread_bits(cells[:, 0])
+            | _spread_bits(cells[:, 1]) << np.uint64(1)
+            | _spread_bits(cells[:, 2]) << np.uint64(2))
+
+
+def morton_decode(codes):
+    """
+    Computes the integer cell coordinates of Morton codes.
+
+    Parameters:
+    codes (ndarray): The Morton codes (uint64).
+
+    Returns:
+    ndarray: The integer cell coordinates, with shape (N, 3).
+    """
+    codes = np.asarray(codes, dtype=np.uint64)
+    return np.stack([_compact_bits(codes),
+                     _compact_bits(codes >> np.uint64(1)),
+                     _compact_bits(codes >> np.uint64(2))], axis=1)
+
+
+def quantize(points, depth, origin=None, size=None):
+    """
+    Converts points to integer cell coordinates of a cubic grid with 2**depth cells per side.
+
+    Parameters:
+    points (ndarray): The vertices of the mesh.
+    depth (int): The octree depth.
+    origin (ndarray): The minimum corner of the cube. Defaults to the minimum of the points.
+    size (float): The side length of the cube. Defaults to the largest side of the bounding box.
+
+    Returns:
+    ndarray: The integer cell coordinates, with shape (N, 3). Points outside the cube are clipped to it.
+    """
+    if origin is None:
+        origin = points.min(axis=0)
+    if size is None:
+        size = float((points.max(axis=0) - origin).max()) or 1.0
+    side = 1 << depth
+    cells = np.floor((points - origin) * (side / size)).astype(np.int64)
+    np.clip(cells, 0, side - 1, out=cells)
+    return cells
+
+
+def build_octree(points, max_depth=10):
+    """
+    Builds an octree of the cells occupied by the points.
+
+    Parameters:
+    points (ndarray): The (aligned) vertices of the mesh.
+    max_depth (int): The depth of the leaf cells (at most 21).
+
+    Returns:
+    Octree: The sorted Morton codes of the occupied leaf cells, their point counts and the cube geometry.
+
+    Explanation:
+    - The cube is the smallest one around the bounding box of the points.
+    - The points are quantized and Morton-encoded in bulk, then sorted once.
+    - The coarser levels are not stored, as they follow from the leaf codes by shifting.
+    """
+    if not 0 <= max_depth <= MAX_DEPTH:
+        raise ValueError(f"max_depth must be between 0 and {MAX_DEPTH}")
+    points = np.asarray(points, dtype=np.float64)
+    origin = points.min(axis=0)
+    size = float((points.max(axis=0) - origin).max()) or 1.0
+    codes = morton_encode(quantize(points, max_depth, origin, size))
+    codes, counts = np.unique(codes, return_counts=True)
+    return Octree(codes, counts.astype(np.int64), origin, size, max_depth)
+
+
+def occupied_cells(octree, depth):
+    """
+    Lists the occupied cells at a given depth.
+
+    Parameters:
+    octree (Octree): The octree returned by `build_octree`.
+    depth (int): The depth, from 0 (the whole cube) to `octree.max_depth`.
+
+    Returns:
+    tuple: A tuple containing the sorted Morton codes of the occupied cells at this depth
+    and the number of points in each.
+
+    Explanation:
+    - Shifting the sorted leaf codes keeps them sorted, so runs of equal codes are merged without sorting again.
+    """
+    if not 0 <= depth <= octree.max_depth:
+        raise ValueError(f"depth must be between 0 and {octree.max_depth}")
+    codes = octree.codes >> np.uint64(3 * (octree.max_depth - depth))
+    if len(codes) == 0:
+        return codes, octree.counts
+    starts = np.flatnonzero(np.concatenate(([True], codes[1:] != codes[:-1])))
+    return codes[starts], np.add.reduceat(octree.counts, starts)
+
+
+def level_occupancy(octree):
+    """
+    Counts the occupied cells at every depth of the octree.
+
+    Parameters:
+    octree (Octree): The octree returned by `build_octree`.
+
+    Returns:
+    ndarray: The number of occupied cells for each depth from 0 to `octree.max_depth`.
+    """
+    return np.array([len(occupied_cells(octree, depth)[0]) for depth in range(octree.max_depth + 1)])
+
+
+def cell_centers(octree, codes, depth):
+    """
+    Computes the centers of cells given by their Morton codes.
+
+    Parameters:
+    octree (Octree): The octree returned by `build_octree`.
+    codes (ndarray): The Morton codes of the cells at `depth`.
+    depth (int): The depth of the cells.
+
+    Returns:
+    ndarray: The cell centers in the coordinates of the points, with shape (N, 3).
+    """
+    cell_size = octree.size / (1 << depth)
+    return octree.origin + (morton_decode(codes) + 0.5) * cell_size
+
+
+def occupied_neighbours(octree, codes, depth):
+    """
+    Finds which of the 26 neighbours of each cell are occupied.
+
+    Parameters:
+    octree (Octree): The octree returned by `build_octree`.
+    codes (ndarray): The Morton codes of the query cells at `depth`.
+    depth (int): The depth of the query cells.
+
+    Returns:
+    ndarray: A boolean array with shape (N, 26); column j refers to `NEIGHBOUR_OFFSETS[j]`.
+
+    Explanation:
+    - The neighbour coordinates of all cells are computed at once and encoded back to Morton codes.
+    - Occupancy is checked with a binary search in the sorted occupied codes of that depth.
+    """
+    occupied, _ = occupied_cells(octree, depth)
+    cells = morton_decode(codes)
+    neighbours = cells[:, np.newaxis, :] + NEIGHBOUR_OFFSETS[np.newaxis, :, :]
+    inside = np.all((neighbours >= 0) & (neighbours < (1 << depth)), axis=2)
+    neighbour_codes = morton_encode(np.clip(neighbours, 0, None).reshape(-1, 3)).reshape(inside.shape)
+    positions = np.searchsorted(occupied, neighbour_codes)
+    found = occupied[np.minimum(positions, len(occupied) - 1)] == neighbour_codes if len(occupied) else False
+    return inside & found
+
+
+def point_cells(octree, points, depth):
+    """
+    Finds the Morton codes of the cells containing the given points.
+
+    Parameters:
+    octree (Octree): The octree returned by `build_octree`.
+    points (ndarray): The points, with shape (N, 3).
+    depth (int): The depth of the cells.
+
+    Returns:
+    ndarray: The Morton codes of the cells at `depth`. Points outside the cube are clipped to it.
+    """
+    return morton_encode(quantize(np.asarray(points, dtype=np.float64), depth, octree.origin, octree.size))
+
+
+def octree_path(stl_path):
+    """
+    Returns the path of the octree cache stored next to a processed STL file.
+    """
+    stl_path = Path(stl_path)
+    return stl_path.with_name(stl_path.stem + ".octree.npz")
+
+
+def save_octree(octree, file_path):
+    """
+    Saves an octree to a compressed NumPy archive.
+
+    Parameters:
+    octree (Octree): The octree returned by `build_octree`.
+    file_path (Path or str): The path of the archive.
+    """
+    np.savez_compressed(file_path, codes=octree.codes, counts=octree.counts, origin=octree.origin,
+                        size=octree.size, max_depth=octree.max_depth)
+
+
+def load_octree(file_path):
+    """
+    Loads an octree saved by `save_octree`.
+
+    Parameters:
+    file_path (Path or str): The path of the archive.
+
+    Returns:
+    Octree: The loaded octree.
+    """
+    with np.load(file_path) as data:
+        return Octree(data["codes"], data["counts"], data["origin"], float(data["size"]), int(data["max_depth"]))
+
+
+def octree_for_file(stl_path, max_depth=10):
+    """
+    Loads the cached octree of a processed STL file, building and caching it if needed.
+
+    Parameters:
+    stl_path (Path or str): The path to the processed STL file.
+    max_depth (int): The depth of the leaf cells.
+
+    Returns:
+    Octree: The octree of the file's vertices.
+
+    Explanation:
+    - The cache is rebuilt if it is missing, older than the STL file, or built with another depth.
+    """
+    cache_path = octree_path(stl_path)
+    if cache_path.exists() and cache_path.stat().st_mtime >= Path(stl_path).stat().st_mtime:
+        octree = load_octree(cache_path)
+        if octree.max_depth == max_depth:
+            return octree
+
+    points, _ = load_stl(stl_path)
+    octree = build_octree(points, max_depth)
+    save_octree(octree, cache_path)
+    return octree
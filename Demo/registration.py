@@ -0,0 +1,298 @@
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from dataset_store import mesh_arrays
+from file_processing import apply_transform, load_stl, save_aligned_stl, voxel_downsample
+
+
+# Result of a registration: the 4x4 transform from the source to the target, and how well it fits
+Registration = namedtuple("Registration", ["matrix", "rmse", "iterations", "converged"])
+
+# Step between the roll angles about the main (Y) axis tried as initial rotations
+ROLL_STEP_DEGREES = 45
+
+# Number of source points matched in each stage of a registration, from coarse to fine
+SAMPLE_SIZES = (1000, 5000, 20000)
+
+
+def initial_rotations(roll_step_degrees=ROLL_STEP_DEGREES):
+    """
+    Builds the initial rotations tried by `register`.
+
+    Parameters:
+    roll_step_degrees (float): The step between the roll angles about the Y axis.
+
+    Returns:
+    ndarray: The rotations, with shape (K, 3, 3): every roll, with the main axis kept and flipped.
+
+    Explanation:
+    - `process_file` aligns the main axis of a scan with Y, which leaves the roll about Y open
+      (the second principal axis of a face is not stable) as well as the direction of the main axis.
+    - The rolls include the half turn about Y, so the four sign flips of the PCA frame are covered.
+    """
+    angles = np.radians(np.arange(0.0, 360.0, roll_step_degrees))
+    rolls = np.zeros((len(angles), 3, 3))
+    rolls[:, 0, 0] = rolls[:, 2, 2] = np.cos(angles)
+    rolls[:, 0, 2] = np.sin(angles)
+    rolls[:, 2, 0] = -np.sin(angles)
+    rolls[:, 1, 1] = 1.0
+    return np.concatenate([rolls, rolls @ np.diag([1.0, -1.0, -1.0])])
+
+
+INITIAL_ROTATIONS = initial_rotations()
+
+
+def kabsch(source, target, weights):
+    """
+    Computes the rigid transforms that best map batches of points onto their correspondences (point-to-point).
+
+    Parameters:
+    source (ndarray): The source points, with shape (K, M, 3).
+    target (ndarray): The corresponding target points, with shape (K, M, 3).
+    weights (ndarray): The weight of each pair (0 to ignore it), with shape (K, M).
+
+    Returns:
+    tuple: A tuple containing the rotations (K, 3, 3) and the translations (K, 3).
+
+    Explanation:
+    - The cross-covariance matrices of all K problems are built with `np.einsum`
+      and decomposed with one batched SVD.
+    - The sign of the last singular vector is fixed so the results are rotations, not reflections.
+    """
+    total = weights.sum(axis=1, keepdims=True)
+    source_mean = np.einsum("km,kmi->ki", weights, source) / total
+    target_mean = np.einsum("km,kmi->ki", weights, target) / total
+    covariance = np.einsum("km,kmi,kmj->kij", weights, source - source_mean[:, np.newaxis],
+                           target - target_mean[:, np.newaxis])
+    u, _, vt = np.linalg.svd(covariance)
+    signs = np.sign(np.linalg.det(np.transpose(vt, (0, 2, 1)) @ np.transpose(u, (0, 2, 1))))
+    correction = np.broadcast_to(np.eye(3), covariance.shape).copy()
+    correction[:, 2, 2] = signs
+    rotations = np.transpose(vt, (0, 2, 1)) @ correction @ np.transpose(u, (0, 2, 1))
+    translations = target_mean - np.einsum("kij,kj->ki", rotations, source_mean)
+    return rotations, translations
+
+
+def rotation_vectors_to_matrices(vectors):
+    """
+    Converts a batch of rotation vectors (axis times angle) to rotation matrices with Rodrigues' formula.
+    """
+    angles = np.linalg.norm(vectors, axis=1)
+    axes = vectors / np.where(angles > 0, angles, 1.0)[:, np.newaxis]
+    cross = np.zeros((len(vectors), 3, 3))
+    cross[:, 0, 1], cross[:, 0, 2], cross[:, 1, 2] = -axes[:, 2], axes[:, 1], -axes[:, 0]
+    cross -= np.transpose(cross, (0, 2, 1))
+    sin = np.sin(angles)[:, np.newaxis, np.newaxis]
+    cos = np.cos(angles)[:, np.newaxis, np.newaxis]
+    return np.eye(3) + sin * cross + (1 - cos) * cross @ cross
+
+
+def point_to_plane(source, target, normals, weights):
+    """
+    Computes the small rigid motions that best move batches of points onto the tangent planes of their
+    correspondences (point-to-plane), linearized around the current pose.
+
+    Parameters:
+    source (ndarray): The source points, with shape (K, M, 3).
+    target (ndarray): The corresponding target points, with shape (K, M, 3).
+    normals (ndarray): The unit normals at the target points, with shape (K, M, 3).
+    weights (ndarray): The weight of each pair (0 to ignore it), with shape (K, M).
+
+    Returns:
+    tuple: A tuple containing the rotations (K, 3, 3) and the translations (K, 3).
+
+    Explanation:
+    - Each pair gives one linear equation in the rotation vector and the translation.
+    - The 6x6 normal equations of all K problems are built with `np.einsum` and solved at once.
+    """
+    rows = np.concatenate([np.cross(source, normals), normals], axis=2)
+    residuals = np.einsum("kmi,kmi->km", target - source, normals)
+    lhs = np.einsum("km,kmi,kmj->kij", weights, rows, rows) + 1e-9 * np.eye(6)
+    rhs = np.einsum("km,kmi,km->ki", weights, rows, residuals)
+    solution = np.linalg.solve(lhs, rhs[..., np.newaxis])[..., 0]
+    return rotation_vectors_to_matrices(solution[:, :3]), solution[:, 3:]
+
+
+def _compose(rotations, translations, step_rotations, step_translations):
+    new_rotations = step_rotations @ rotations
+    new_translations = np.einsum("kij,kj->ki", step_rotations, translations) + step_translations
+    return new_rotations, new_translations
+
+
+def _icp_stage(sample, target, normals, tree, rotations, translations, method, iterations, tolerance, trim,
+               min_spread):
+    # Refines K poses of the same sample; returns the poses, their RMS distances, the iterations run and convergence
+    rmse = np.full(len(rotations), np.inf)
+    for iteration in range(1, iterations + 1):
+        moved = np.einsum("kij,mj->kmi", rotations, sample) + translations[:, np.newaxis]
+        distances, indices = tree.query(moved.reshape(-1, 3), workers=-1)
+        distances = distances.reshape(moved.shape[:2])
+        indices = indices.reshape(moved.shape[:2])
+        threshold = np.quantile(distances, trim, axis=1, keepdims=True)
+        weights = (distances <= threshold).astype(np.float64)
+        rmse = np.sqrt((weights * distances ** 2).sum(axis=1) / weights.sum(axis=1))
+
+        if method == "point_to_plane":
+            step_rotations, step_translations = point_to_plane(moved, target[indices], normals[indices], weights)
+        else:
+            step_rotations, step_translations = kabsch(moved, target[indices], weights)
+        rotations, translations = _compose(rotations, translations, step_rotations, step_translations)
+
+        # Rotation change in radians, translation change relative to the spread of the kept pairs (which is 0 for
+        # an exact fit, hence the floor)
+        change = (np.abs(step_rotations - np.eye(3)).max(axis=(1, 2))
+                  + np.abs(step_translations).max(axis=1) / np.maximum(threshold[:, 0], min_spread))
+        if change.max() < tolerance:
+            return rotations, translations, rmse, iteration, True
+    return rotations, translations, rmse, iterations, False
+
+
+def register(source, target, target_normals=None, tree=None, method="point_to_plane", hypotheses=INITIAL_ROTATIONS,
+             iterations=20, tolerance=1e-4, trim=0.9, sample_sizes=SAMPLE_SIZES, coarse_points=5000, seed=0):
+    """
+    Refines the alignment of a scan to a reference (e.g. its template) with the iterative closest point method.
+
+    Parameters:
+    source (ndarray): The vertices of the scan, already aligned by `process_file`.
+    target (ndarray): The vertices of the reference, aligned the same way.
+    target_normals (ndarray): The unit normals at the target vertices; required for point-to-plane.
+    tree (cKDTree): The KD-tree of the target, if one is already built.
+    method (str): "point_to_plane" or "point_to_point"; used after the coarse stage.
+    hypotheses (ndarray): The initial rotations tried, with shape (K, 3, 3) (see `initial_rotations`).
+    iterations (int): The maximum number of iterations per stage.
+    tolerance (float): The change of the transform below which a stage has converged.
+    trim (float): The fraction of closest correspondences used in each update; the others are outliers.
+    sample_sizes (tuple): The number of random source points matched in each stage, from coarse to fine.
+    coarse_points (int): The approximate number of voxel centroids the target is reduced to for the coarse stage.
+    seed (int): The seed of the random samples.
+
+    Returns:
+    Registration: The 4x4 transform from the scan to the reference and the RMS distance of the kept pairs.
+
+    Explanation:
+    - The coarse stage matches the smallest sample against a voxel-downsampled copy of the target, for all
+      hypotheses at once; their transforms are computed in one batched SVD. Only the best one is kept.
+    - The next stages use larger samples against the full target, so the early iterations are cheap and
+      the last ones are accurate. Each stage keeps its sample fixed, so it converges.
+    - The closest target points of all sampled points are found in one KD-tree query per iteration.
+    """
+    source = np.asarray(source, dtype=np.float64)
+    target = np.asarray(target, dtype=np.float64)
+    if method == "point_to_plane" and target_normals is None:
+        raise ValueError("point_to_plane registration needs target_normals")
+    rng = np.random.default_rng(seed)
+
+    extent = target.max(axis=0) - target.min(axis=0)
+    min_spread = 1e-9 * float(np.linalg.norm(extent)) or 1e-12
+    voxel_size = float(np.prod(extent[extent > 0]) / coarse_points) ** (1 / max(int((extent > 0).sum()), 1))
+    coarse_target, _ = voxel_downsample(target, voxel_size or 1.0, target.min(axis=0))
+
+    rotations = np.array(hypotheses, dtype=np.float64)
+    translations = np.zeros((len(rotations), 3))
+    total_iterations = 0
+    converged = False
+    for stage, sample_size in enumerate(sample_sizes):
+        sample = source[rng.integers(0, len(source), size=min(sample_size, len(source)))]
+        if stage == 0:
+            rotations, translations, rmse, run, converged = _icp_stage(
+                sample, coarse_target, None, cKDTree(coarse_target), rotations, translations,
+                "point_to_point", iterations, tolerance, trim, min_spread)
+            best = int(np.argmin(rmse))
+            rotations, translations = rotations[best:best + 1], translations[best:best + 1]
+            tree = tree if tree is not None else cKDTree(target)
+        else:
+            rotations, translations, rmse, run, converged = _icp_stage(
+                sample, target, target_normals, tree, rotations, translations, method, iterations, tolerance, trim,
+                min_spread)
+        total_iterations += run
+
+    matrix = np.eye(4)
+    matrix[:3, :3] = rotations[0]
+    matrix[:3, 3] = translations[0]
+    return Registration(matrix, float(rmse.min()), total_iterations, converged)
+
+
+def vertex_normals(vertices, faces):
+    """
+    Computes area-weighted unit normals at the vertices of a mesh.
+
+    Parameters:
+    vertices (ndarray): The vertices, with shape (N, 3).
+    faces (ndarray): The vertex indices of each triangle, with shape (M, 3).
+
+    Returns:
+    ndarray: The unit normals, with shape (N, 3).
+
+    Explanation:
+    - The cross product of two edges of a triangle is its normal scaled by twice its area.
+    - They are summed at the corners of all triangles with `np.bincount`, then normalized.
+    """
+    vertices = np.asarray(vertices, dtype=np.float64)
+    triangles = vertices[faces]
+    face_normals = np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+    corners = np.asarray(faces).ravel()
+    normals = np.stack([np.bincount(corners, weights=np.repeat(face_normals[:, axis], 3), minlength=len(vertices))
+                        for axis in range(3)], axis=1)
+    lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+    np.divide(normals, lengths, out=normals, where=lengths > 0)
+    return normals
+
+
+def register_file(scan_path, template_path, output_path=None, method="point_to_plane"):
+    """
+    Registers a processed scan to a processed template and optionally saves the registered scan.
+
+    Parameters:
+    scan_path (Path or str): The path to the processed scan.
+    template_path (Path or str): The path to the processed template (the reference).
+    output_path (Path or str): If given, the path to save the scan moved onto the template.
+    method (str): "point_to_plane" or "point_to_point".
+
+    Returns:
+    Registration: The transform from the scan to the template and its fit.
+    """
+    source, source_mesh = load_stl(scan_path)
+    target, faces = mesh_arrays(*load_stl(template_path))
+    normals = vertex_normals(target, faces) if method == "point_to_plane" else None
+    registration = register(source, target, normals, method=method)
+    if output_path is not None:
+        points = np.array(source)
+        apply_transform(points, registration.matrix)
+        save_aligned_stl(points, source_mesh, output_path)
+    return registration
+
+
+def _register_one(scan_path, template_path, output_path, method):
+    try:
+        return register_file(scan_path, template_path, output_path, method), None
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+
+
+def register_batch(pairs, output_dir=None, workers=None, method="point_to_plane"):
+    """
+    Registers many scans to their templates in parallel using a process pool.
+
+    Parameters:
+    pairs (list): A list of tuples containing the path of a processed scan and of its template.
+    output_dir (Path or str): If given, the folder where the registered scans are saved (same file names).
+    workers (int): The number of worker processes. Defaults to the number of CPUs.
+    method (str): "point_to_plane" or "point_to_point".
+
+    Returns:
+    list: A list of tuples containing the `Registration` (or None) and the error (or None) of each pair,
+    in the same order as `pairs`.
+    """
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+    jobs = [(scan_path, template_path, Path(output_dir) / Path(scan_path).name if output_dir else None, method)
+            for scan_path, template_path in pairs]
+    if workers == 1:
+        return [_register_one(*job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(_register_one, *zip(*jobs))) if jobs else []
@@ -0,0 +1,216 @@
+import json
+import os
+from collections import namedtuple
+from pathlib import Path
+
+import numpy as np
+
+from dataset_store import scan_metadata
+from file_processing import load_stl, point_moments
+
+
+# Files of a shape index, inside the index folder
+DESCRIPTORS_NAME = "descriptors.npy"
+ENTRIES_NAME = "entries.json"
+
+# Number of histogram bins and of random point pairs/triples used for one descriptor
+DISTANCE_BINS = 32
+ANGLE_BINS = 16
+SAMPLES = 20000
+
+# Weights of the three parts of a descriptor in the distance between two scans
+DISTANCE_WEIGHT = 1.0
+ANGLE_WEIGHT = 0.5
+SCALE_WEIGHT = 1.0
+
+DESCRIPTOR_SIZE = DISTANCE_BINS + ANGLE_BINS + 3
+
+# Descriptors of the indexed scans, one row each, and the metadata of each row
+ShapeIndex = namedtuple("ShapeIndex", ["descriptors", "entries"])
+
+
+def shape_descriptor(points, samples=SAMPLES, seed=0):
+    """
+    Computes a compact shape descriptor of a point cloud that does not depend on its position or rotation.
+
+    Parameters:
+    points (ndarray): The vertices of the mesh, aligned or not.
+    samples (int): The number of random point pairs and triples.
+    seed (int): The seed of the random samples, so the same scan always gets the same descriptor.
+
+    Returns:
+    ndarray: The descriptor (float32), with `DESCRIPTOR_SIZE` values.
+
+    Explanation:
+    - The first part is the histogram of the distances between random point pairs (D2), divided by
+      the RMS radius of the scan, so it describes the shape and not the size.
+    - The second part is the histogram of the angles in random point triples (A3).
+    - The last part is the logarithm of the standard deviations along the principal axes, which keeps
+      the size of the face, as it matters for the fit of a mask.
+    - All samples are drawn and measured at once; the histograms are square-rooted (Hellinger)
+      so that Euclidean distances between descriptors compare them well.
+    """
+    points = np.asarray(points)
+    _, covariance = point_moments(points)
+    variances = np.clip(np.linalg.eigvalsh(covariance)[::-1], 1e-12, None)
+    rms_radius = float(np.sqrt(variances.sum())) or 1.0
+
+    rng = np.random.default_rng(seed)
+    picks = points[rng.integers(0, len(points), size=(samples, 3))].astype(np.float64)
+
+    distances = np.linalg.norm(picks[:, 0] - picks[:, 1], axis=1) / rms_radius
+    distance_histogram, _ = np.histogram(distances, bins=DISTANCE_BINS, range=(0.0, 4.0))
+
+    first = picks[:, 0] - picks[:, 1]
+    second = picks[:, 2] - picks[:, 1]
+    lengths = np.linalg.norm(first, axis=1) * np.linalg.norm(second, axis=1)
+    valid = lengths > 0
+    cosines = np.einsum("ij,ij->i", first[valid], second[valid]) / lengths[valid]
+    angle_histogram, _ = np.histogram(np.arccos(np.clip(cosines, -1.0, 1.0)), bins=ANGLE_BINS, range=(0.0, np.pi))
+
+    return np.concatenate([
+        DISTANCE_WEIGHT * np.sqrt(distance_histogram / max(distance_histogram.sum(), 1)),
+        ANGLE_WEIGHT * np.sqrt(angle_histogram / max(angle_histogram.sum(), 1)),
+        SCALE_WEIGHT * 0.5 * np.log(variances),
+    ]).astype(np.float32)
+
+
+def open_shape_index(index_dir, mmap=True):
+    """
+    Loads a shape index, or returns an empty one if the folder does not contain an index yet.
+
+    Parameters:
+    index_dir (Path or str): The folder of the index.
+    mmap (bool): Whether to map the descriptors instead of reading them. A mapped file cannot be replaced
+    on Windows, so an index that is going to be saved again is read.
+
+    Returns:
+    ShapeIndex: The descriptor matrix (N, `DESCRIPTOR_SIZE`) and the metadata of each row.
+    """
+    index_dir = Path(index_dir)
+    if not (index_dir / ENTRIES_NAME).exists():
+        return ShapeIndex(np.empty((0, DESCRIPTOR_SIZE), dtype=np.float32), [])
+    with open(index_dir / ENTRIES_NAME, encoding="utf-8") as f:
+        entries = json.load(f)
+    descriptors = np.load(index_dir / DESCRIPTORS_NAME, mmap_mode="r" if mmap else None)
+    if descriptors.shape != (len(entries), DESCRIPTOR_SIZE):
+        raise ValueError(f"Shape index in {index_dir} is inconsistent or was built with other settings")
+    return ShapeIndex(descriptors, entries)
+
+
+def save_shape_index(index, index_dir):
+    """
+    Saves a shape index; the descriptors are written before the entries, and both are replaced atomically.
+    """
+    index_dir = Path(index_dir)
+    os.makedirs(index_dir, exist_ok=True)
+    with open(index_dir / (DESCRIPTORS_NAME + ".tmp"), "wb") as f:
+        np.save(f, np.ascontiguousarray(index.descriptors, dtype=np.float32))
+    with open(index_dir / (ENTRIES_NAME + ".tmp"), "w", encoding="utf-8") as f:
+        json.dump(index.entries, f, indent=1)
+    os.replace(index_dir / (DESCRIPTORS_NAME + ".tmp"), index_dir / DESCRIPTORS_NAME)
+    os.replace(index_dir / (ENTRIES_NAME + ".tmp"), index_dir / ENTRIES_NAME)
+
+
+def update_shape_index(index_dir, file_paths):
+    """
+    Adds scans to a shape index, or updates them if they changed.
+
+    Parameters:
+    index_dir (Path or str): The folder of the index.
+    file_paths (iterable): The paths of the STL files (e.g. face scans of the repository or processed scans).
+
+    Returns:
+    int: The number of descriptors computed. Files with the same path, size and mtime are skipped.
+
+    Explanation:
+    - The metadata (patient ID and file type) comes from the file names, see `dataset_store.scan_metadata`.
+    - The index is small (about 200 bytes per scan), so it is read into memory and rewritten as a whole
+      after an update.
+    """
+    index = open_shape_index(index_dir, mmap=False)
+    descriptors = index.descriptors
+    entries = list(index.entries)
+    rows = {entry["path"]: i for i, entry in enumerate(entries)}
+
+    new_rows = []
+    computed = 0
+    for file_path in file_paths:
+        stat = os.stat(file_path)
+        row = rows.get(str(file_path))
+        if row is not None and (entries[row]["size"], entries[row]["mtime_ns"]) == (stat.st_size, stat.st_mtime_ns):
+            continue
+        points, _ = load_stl(file_path)
+        metadata = scan_metadata(file_path)
+        entry = {"path": str(file_path), "patient_id": metadata["patient_id"], "file_type": metadata["file_type"],
+                 "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+        descriptor = shape_descriptor(points)
+        computed += 1
+        if row is None:
+            rows[str(file_path)] = len(entries)
+            entries.append(entry)
+            new_rows.append(descriptor)
+        else:
+            entries[row] = entry
+            descriptors[row] = descriptor
+
+    if new_rows:
+        descriptors = np.concatenate([descriptors, np.stack(new_rows)])
+    if computed:
+        save_shape_index(ShapeIndex(descriptors, entries), index_dir)
+    return computed
+
+
+def nearest_scans(index, descriptor, k=5, file_type="face_scan"):
+    """
+    Finds the indexed scans most similar to a descriptor.
+
+    Parameters:
+    index (ShapeIndex): The index returned by `open_shape_index`.
+    descriptor (ndarray): The descriptor of the query scan, from `shape_descriptor`.
+    k (int): The number of results.
+    file_type (str): Only rows of this file type are compared (None compares all of them).
+
+    Returns:
+    list: A list of tuples containing the metadata entry and the distance of each result, closest first.
+
+    Explanation:
+    - The distances to all rows are computed with one matrix-vector product.
+    - `np.argpartition` selects the k closest rows without sorting all of them.
+    """
+    rows = np.arange(len(index.entries))
+    if file_type is not None:
+        rows = rows[[entry["file_type"] == file_type for entry in index.entries]] if len(rows) else rows
+    if len(rows) == 0:
+        return []
+    candidates = np.asarray(index.descriptors[rows], dtype=np.float32)
+    query = np.asarray(descriptor, dtype=np.float32)
+    squared = np.einsum("ij,ij->i", candidates, candidates) - 2 * (candidates @ query) + query @ query
+    distances = np.sqrt(np.clip(squared, 0, None))
+    k = min(k, len(rows))
+    best = np.argpartition(distances, k - 1)[:k]
+    best = best[np.argsort(distances[best])]
+    return [(index.entries[rows[i]], float(distances[i])) for i in best]
+
+
+def suggest_patients(index, points, k=5):
+    """
+    Suggests the patients whose face scans are most similar to a new face scan.
+
+    Parameters:
+    index (ShapeIndex): The index returned by `open_shape_index`, with the face scans of the repository.
+    points (ndarray): The vertices of the new face scan (e.g. returned by `process_file`).
+    k (int): The number of patients.
+
+    Returns:
+    list: A list of tuples containing the patient ID and the distance, closest first. Their masks and
+    templates are candidates for the new face.
+    """
+    results = []
+    seen = set()
+    # A patient can have several face scans, so a few more rows are fetched than needed
+    for entry, distance in nearest_scans(index, shape_descriptor(points), 3 * k):
+        if entry["patient_id"] not in seen:
+            seen.add(entry["patient_id"])
+            results.append((entry["patient_id"], distance))
+    return results[:k]
@@ -0,0 +1,279 @@
+import pickle
+from collections import OrderedDict, namedtuple
+from pathlib import Path
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from file_processing import load_stl
+from stl_io import write_binary_stl
+
+
+# Suffix of the spatial index cache stored next to a processed STL file
+INDEX_SUFFIX = ".kdtree.pkl"
+
+# KD-tree of the points of a scan, with the points sorted along each axis for slab queries
+SpatialIndex = namedtuple("SpatialIndex", ["tree", "order", "sorted_coordinates"])
+
+# Box given as fractions (0 to 1) of the bounding box of an aligned scan, per axis (X, Y, Z)
+Region = namedtuple("Region", ["lower", "upper"])
+
+# Regions covered by the mask, for scans aligned by `process_file` (face height along Y, chin at the bottom)
+FACIAL_REGIONS = {
+    "nose_to_chin": Region((0.15, 0.0, 0.0), (0.85, 0.6, 1.0)),
+    "nasal": Region((0.3, 0.35, 0.0), (0.7, 0.6, 1.0)),
+    "perioral": Region((0.2, 0.15, 0.0), (0.8, 0.4, 1.0)),
+    "chin": Region((0.25, 0.0, 0.0), (0.75, 0.2, 1.0)),
+}
+
+# Number of scans whose index, points and mesh are kept in memory, most recently used first. Each one holds
+# its KD-tree, points and memory-mapped file (which stays locked on Windows while it is mapped).
+LOADED_INDEX_LIMIT = 4
+
+# Indexes already loaded in this process, by STL path, least recently used first
+_loaded_indexes = OrderedDict()
+
+
+def build_spatial_index(points, leafsize=32):
+    """
+    Builds the spatial index of a point cloud.
+
+    Parameters:
+    points (ndarray): The (aligned) vertices of the mesh.
+    leafsize (int): The number of points in the leaves of the KD-tree.
+
+    Returns:
+    SpatialIndex: The KD-tree of the points and their order along each axis.
+
+    Explanation:
+    - The KD-tree answers radius and box queries without looking at every point.
+    - Slabs are unbounded along two axes, so they are answered with a binary search
+      in the points sorted along the third axis instead.
+    - The sorted coordinates keep the type of the points (float32 for binary STL) and the order
+      is stored as int32 when possible, which keeps the cache on disk small.
+    """
+    points = np.asarray(points)
+    tree = cKDTree(points, leafsize=leafsize, balanced_tree=False)
+    order = np.argsort(points, axis=0, kind="stable").T
+    sorted_coordinates = np.take_along_axis(points, order.T, axis=0).T.copy()
+    if len(points) < 2 ** 31:
+        order = order.astype(np.int32)
+    return SpatialIndex(tree, order, sorted_coordinates)
+
+
+def radius_query(index, center, radius):
+    """
+    Finds the points within a distance of a center point.
+
+    Parameters:
+    index (SpatialIndex): The index returned by `build_spatial_index`.
+    center (array-like): The center point.
+    radius (float): The search radius.
+
+    Returns:
+    ndarray: The sorted indices of the points.
+    """
+    return np.sort(np.asarray(index.tree.query_ball_point(center, radius), dtype=np.int64))
+
+
+def box_query(index, lower, upper):
+    """
+    Finds the points inside an axis-aligned box.
+
+    Parameters:
+    index (SpatialIndex): The index returned by `build_spatial_index`.
+    lower (array-like): The minimum corner of the box.
+    upper (array-like): The maximum corner of the box.
+
+    Returns:
+    ndarray: The sorted indices of the points.
+
+    Explanation:
+    - The KD-tree returns the points in the smallest cube (Chebyshev ball) around the box,
+      which are then filtered against the box itself.
+    """
+    lower = np.asarray(lower, dtype=np.float64)
+    upper = np.asarray(upper, dtype=np.float64)
+    center = (lower + upper) / 2
+    half_size = float((upper - lower).max()) / 2
+    candidates = np.asarray(index.tree.query_ball_point(center, half_size, p=np.inf), dtype=np.int64)
+    if len(candidates) == 0:
+        return candidates
+    points = index.tree.data[candidates]
+    inside = np.all((points >= lower) & (points <= upper), axis=1)
+    return np.sort(candidates[inside])
+
+
+def slab_query(index, axis, low, high):
+    """
+    Finds the points between two planes orthogonal to an axis.
+
+    Parameters:
+    index (SpatialIndex): The index returned by `build_spatial_index`.
+    axis (int): The axis of the slab (0 for X, 1 for Y, 2 for Z).
+    low (float): The lower bound along the axis.
+    high (float): The upper bound along the axis.
+
+    Returns:
+    ndarray: The sorted indices of the points.
+    """
+    coordinates = index.sorted_coordinates[axis]
+    start = np.searchsorted(coordinates, low, side="left")
+    stop = np.searchsorted(coordinates, high, side="right")
+    return np.sort(index.order[axis, start:stop]).astype(np.int64)
+
+
+def region_bounds(index, region, chin_down=True):
+    """
+    Converts a region given in fractions of the bounding box to coordinates.
+
+    Parameters:
+    index (SpatialIndex): The index returned by `build_spatial_index`.
+    region (Region or str): The region, or the name of one of the `FACIAL_REGIONS`.
+    chin_down (bool): Whether the chin is at the low end of the Y axis; otherwise the region is mirrored along Y.
+
+    Returns:
+    tuple: A tuple containing the minimum and maximum corners of the region.
+    """
+    if isinstance(region, str):
+        region = FACIAL_REGIONS[region]
+    lower = np.array(region.lower, dtype=np.float64)
+    upper = np.array(region.upper, dtype=np.float64)
+    if not chin_down:
+        lower[1], upper[1] = 1 - upper[1], 1 - lower[1]
+    mins, maxes = index.tree.mins, index.tree.maxes
+    return mins + lower * (maxes - mins), mins + upper * (maxes - mins)
+
+
+def region_query(index, region, chin_down=True):
+    """
+    Finds the points inside a facial region.
+
+    Parameters:
+    index (SpatialIndex): The index returned by `build_spatial_index`.
+    region (Region or str): The region, or the name of one of the `FACIAL_REGIONS`.
+    chin_down (bool): Whether the chin is at the low end of the Y axis.
+
+    Returns:
+    ndarray: The sorted indices of the points.
+    """
+    return box_query(index, *region_bounds(index, region, chin_down))
+
+
+def crop_triangles(points, mesh, point_indices):
+    """
+    Extracts the triangles whose corners are all in a set of points.
+
+    Parameters:
+    points (ndarray): The vertices of the mesh, as returned by `load_stl`.
+    mesh (trimesh.Trimesh or TriangleMesh): The mesh object returned by `load_stl`.
+    point_indices (ndarray): The indices of the points to keep, e.g. from `region_query`.
+
+    Returns:
+    ndarray: The corners of the kept triangles, with shape (M, 3, 3).
+
+    Explanation:
+    - The mask of the points is looked up through the faces.
+    """
+    inside = np.zeros(len(points), dtype=bool)
+    inside[point_indices] = True
+    faces = np.asarray(mesh.faces)
+    keep = inside[faces].all(axis=1)
+    return np.asarray(points)[faces[keep]]
+
+
+def index_path(stl_path):
+    """
+    Returns the path of the spatial index cache stored next to a processed STL file.
+    """
+    stl_path = Path(stl_path)
+    return stl_path.with_name(stl_path.stem + INDEX_SUFFIX)
+
+
+def save_spatial_index(index, file_path):
+    """
+    Saves a spatial index; the KD-tree is pickled with its nodes, so it is not built again when loaded.
+    """
+    with open(file_path, "wb") as f:
+        pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_spatial_index(file_path):
+    """
+    Loads a spatial index saved by `save_spatial_index`.
+    """
+    with open(file_path, "rb") as f:
+        return pickle.load(f)
+
+
+def spatial_index_for_file(stl_path):
+    """
+    Returns the spatial index of a processed STL file, building and caching it if needed.
+
+    Parameters:
+    stl_path (Path or str): The path to the processed STL file.
+
+    Returns:
+    tuple: A tuple containing the spatial index, the points and the mesh object returned by `load_stl`.
+
+    Explanation:
+    - The last `LOADED_INDEX_LIMIT` scans are kept in memory, and every index is cached on disk next to
+      the STL file, so cropping a whole archive keeps memory bounded.
+    - The cache on disk is rebuilt if it is missing or older than the STL file.
+    """
+    stl_path = Path(stl_path)
+    mtime_ns = stl_path.stat().st_mtime_ns
+    loaded = _loaded_indexes.get(stl_path)
+    if loaded is not None and loaded[0] == mtime_ns:
+        _loaded_indexes.move_to_end(stl_path)
+        return loaded[1:]
+
+    points, mesh = load_stl(stl_path)
+    cache_path = index_path(stl_path)
+    index = None
+    if cache_path.exists() and cache_path.stat().st_mtime_ns >= mtime_ns:
+        try:
+            index = load_spatial_index(cache_path)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError) as e:
+            print(f"Warning: ignoring unreadable spatial index {cache_path}: {e}")
+        if index is not None and index.tree.n != len(points):
+            index = None
+    if index is None:
+        index = build_spatial_index(points)
+        save_spatial_index(index, cache_path)
+
+    _loaded_indexes[stl_path] = (mtime_ns, index, points, mesh)
+    _loaded_indexes.move_to_end(stl_path)
+    while len(_loaded_indexes) > LOADED_INDEX_LIMIT:
+        _loaded_indexes.popitem(last=False)
+    return index, points, mesh
+
+
+def clear_loaded_indexes():
+    """
+    Drops the scans kept in memory by `spatial_index_for_file`, e.g. to release their files.
+    """
+    _loaded_indexes.clear()
+
+
+def crop_file(input_path, output_path, region="nose_to_chin", chin_down=True):
+    """
+    Crops a processed STL file to a facial region and saves the cropped mesh.
+
+    Parameters:
+    input_path (Path or str): The path to the processed (aligned) STL file.
+    output_path (Path or str): The path to save the cropped STL file.
+    region (Region or str): The region, or the name of one of the `FACIAL_REGIONS`.
+    chin_down (bool): Whether the chin is at the low end of the Y axis.
+
+    Returns:
+    int: The number of triangles in the cropped mesh.
+
+    Explanation:
+    - The spatial index of the scan is built once and reused for every region cropped from it.
+    - Only the triangles with all three corners in the region are kept.
+    """
+    index, points, mesh = spatial_index_for_file(input_path)
+    triangles = crop_triangles(points, mesh, region_query(index, region, chin_down))
+    write_binary_stl(output_path, triangles, header=b"cropped")
+    return len(triangles)
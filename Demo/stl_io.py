@@ -0,0 +1,196 @@
+import os
+from collections import namedtuple
+
+import numpy as np
+
+
+# Layout of one triangle record in a binary STL file (50 bytes, little-endian)
+STL_RECORD_DTYPE = np.dtype([
+    ("normal", "<f4", (3,)),
+    ("vertices", "<f4", (3, 3)),
+    ("attributes", "<u2"),
+])
+STL_HEADER_SIZE = 80
+STL_DATA_OFFSET = STL_HEADER_SIZE + 4
+
+# A binary STL mesh with shared vertices: the vertex indices of each triangle (like `trimesh.Trimesh.faces`)
+# and the memory-mapped triangle records it was read from
+TriangleMesh = namedtuple("TriangleMesh", ["faces", "records"])
+
+
+def is_binary_stl(file_path):
+    """
+    Checks whether a file is a binary STL file.
+
+    Parameters:
+    file_path (Path or str): The path to the file.
+
+    Returns:
+    bool: True if the file is a binary STL file, False otherwise.
+
+    Explanation:
+    - Reads the triangle count stored after the 80-byte header.
+    - The file is binary only if its size matches the header, count and 50-byte records exactly.
+    - ASCII STL files (and anything else) do not pass this check.
+    """
+    if os.path.splitext(str(file_path))[1].lower() != ".stl":
+        return False
+    size = os.path.getsize(file_path)
+    if size < STL_DATA_OFFSET:
+        return False
+    with open(file_path, "rb") as f:
+        f.seek(STL_HEADER_SIZE)
+        count = int(np.frombuffer(f.read(4), dtype="<u4")[0])
+    return size == STL_DATA_OFFSET + count * STL_RECORD_DTYPE.itemsize
+
+
+def read_binary_stl(file_path):
+    """
+    Memory-maps the triangle records of a binary STL file.
+
+    Parameters:
+    file_path (Path or str): The path to the binary STL file.
+
+    Returns:
+    ndarray: A read-only structured array with the fields `normal`, `vertices` and `attributes`.
+
+    Explanation:
+    - No data is read or copied up front; pages are loaded by the OS when accessed.
+    - `records["vertices"]` is a strided (N, 3, 3) view of the triangle corners.
+    """
+    with open(file_path, "rb") as f:
+        f.seek(STL_HEADER_SIZE)
+        count = int(np.frombuffer(f.read(4), dtype="<u4")[0])
+    if count == 0:
+        return np.zeros(0, dtype=STL_RECORD_DTYPE)
+    return np.memmap(file_path, dtype=STL_RECORD_DTYPE, mode="r", offset=STL_DATA_OFFSET, shape=(count,))
+
+
+def merge_vertices(triangles):
+    """
+    Merges the repeated corners of triangles into shared vertices.
+
+    Parameters:
+    triangles (ndarray): The triangle corners, with shape (N, 3, 3), e.g. the strided view `records["vertices"]`.
+
+    Returns:
+    tuple: A tuple containing the vertices (float32, shape (V, 3)) and the faces (int32, shape (N, 3)).
+
+    Explanation:
+    - Each vertex of a closed mesh is repeated in about six triangle records.
+    - The bit patterns of the coordinates are read straight from the (possibly strided) corners as two
+      integer keys. They are mixed into one 64-bit key, which is sorted once (about twice as fast as
+      `np.lexsort` on both keys), and the runs of equal coordinates are numbered.
+    - Distinct vertices with the same mixed key may stay interleaved; they are then not merged, which
+      only leaves a duplicate vertex.
+    - Only the keys and the merged vertices are copied; the corners themselves are not.
+    """
+    if len(triangles) == 0:
+        return np.empty((0, 3), dtype=np.float32), np.empty((0, 3), dtype=np.int32)
+    bits = np.asarray(triangles, dtype="<f4").view(np.uint32)
+    high = (bits[..., 0].astype(np.uint64) << np.uint64(32) | bits[..., 1]).ravel()
+    low = bits[..., 2].ravel()
+    order = np.argsort(high * np.uint64(0x9E3779B97F4A7C15) ^ low)
+    high, low = high[order], low[order]
+    first = np.concatenate(([True], (high[1:] != high[:-1]) | (low[1:] != low[:-1])))
+    faces = np.empty(len(order), dtype=np.int32)
+    faces[order] = np.cumsum(first) - 1
+    corners = order[first]
+    vertices = np.array(triangles[corners // 3, corners % 3], dtype=np.float32)
+    return vertices, faces.reshape(-1, 3)
+
+
+def iter_binary_stl_chunks(file_path, chunk_size):
+    """
+    Reads the triangle records of a binary STL file in fixed-size chunks.
+
+    Parameters:
+    file_path (Path or str): The path to the binary STL file.
+    chunk_size (int): The maximum number of triangles per chunk.
+
+    Yields:
+    ndarray: A structured array of at most `chunk_size` triangle records.
+
+    Explanation:
+    - Each chunk is read into its own buffer, so at most one chunk is held in memory at a time.
+    """
+    with open(file_path, "rb") as f:
+        f.seek(STL_HEADER_SIZE)
+        remaining = int(np.frombuffer(f.read(4), dtype="<u4")[0])
+        while remaining > 0:
+            records = np.fromfile(f, dtype=STL_RECORD_DTYPE, count=min(chunk_size, remaining))
+            if len(records) == 0:
+                break
+            remaining -= len(records)
+            yield records
+
+
+def write_binary_stl_header(f, count, header=b"aligned"):
+    """
+    Writes the 80-byte header and the triangle count of a binary STL file.
+
+    Parameters:
+    f (file): The file object, opened in binary mode at its start.
+    count (int): The number of triangles that follow.
+    header (bytes): The text stored in the 80-byte header.
+    """
+    f.write(header[:STL_HEADER_SIZE].ljust(STL_HEADER_SIZE, b"\0"))
+    f.write(np.array([count], dtype="<u4").tobytes())
+
+
+def triangle_normals(triangles):
+    """
+    Computes the unit normals of a set of triangles.
+
+    Parameters:
+    triangles (ndarray): The triangle corners, with shape (N, 3, 3).
+
+    Returns:
+    ndarray: The unit normals, with shape (N, 3). Degenerate triangles get a zero normal.
+    """
+    normals = np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+    lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+    np.divide(normals, lengths, out=normals, where=lengths > 0)
+    return normals
+
+
+def write_binary_stl(file_path, triangles, attributes=None, header=b"aligned", faces=None, chunk_size=1 << 20):
+    """
+    Writes triangles to a binary STL file.
+
+    Parameters:
+    file_path (Path or str): The path to save the STL file.
+    triangles (ndarray): The triangle corners, with shape (N, 3, 3) or (3N, 3), or the shared vertices if
+    `faces` is given.
+    attributes (ndarray): The optional per-triangle attribute words to keep.
+    header (bytes): The text stored in the 80-byte header.
+    faces (ndarray): The optional vertex indices of each triangle, with shape (N, 3).
+    chunk_size (int): The number of triangles gathered from the shared vertices at once.
+
+    Explanation:
+    - The output file is memory-mapped and the coordinates are written straight into it.
+    - With `faces`, the corners are gathered from the vertices chunk by chunk into the mapped records.
+    - The normals are recomputed in bulk from the written coordinates.
+    """
+    if faces is None:
+        triangles = np.asarray(triangles).reshape(-1, 3, 3)
+    count = len(triangles if faces is None else faces)
+    with open(file_path, "wb") as f:
+        write_binary_stl_header(f, count, header)
+        if count:
+            # Grow the file to its final size so the records can be mapped
+            f.seek(count * STL_RECORD_DTYPE.itemsize - 1, os.SEEK_CUR)
+            f.write(b"\0")
+    if count == 0:
+        return
+
+    records = np.memmap(file_path, dtype=STL_RECORD_DTYPE, mode="r+", offset=STL_DATA_OFFSET, shape=(count,))
+    if faces is None:
+        records["vertices"] = triangles
+    else:
+        for start in range(0, count, chunk_size):
+            records["vertices"][start:start + chunk_size] = triangles[faces[start:start + chunk_size]]
+    records["normal"] = triangle_normals(records["vertices"])
+    records["attributes"] = 0 if attributes is None else attributes
+    records.flush()
+    del records
@@ -0,0 +1,276 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(REPO_DIR, "Demo"))
+
+import file_processing  # noqa: E402
+from stl_io import write_binary_stl  # noqa: E402
+import file_index  # noqa: E402
+import reporting_script  # noqa: E402
+import traversal  # noqa: E402
+import new_files_script  # noqa: E402
+
+
+def make_synthetic_scan(file_path, n_vertices, seed=0):
+    # A face-like height field on a grid, randomly rotated and moved away from the origin like a raw scan
+    rng = np.random.default_rng(seed)
+    cols = max(int(np.sqrt(n_vertices * 0.75)), 2)
+    rows = max(n_vertices // cols, 2)
+    y, x = np.meshgrid(np.linspace(-1.2, 1.2, rows), np.linspace(-0.8, 0.8, cols), indexing="ij")
+    z = 0.5 * np.sqrt(np.clip(1 - x ** 2 / 0.8 - y ** 2 / 1.6, 0, None))
+    z += 0.15 * np.exp(-(x ** 2 + (y - 0.1) ** 2) / 0.01)  # nose
+    z += rng.normal(scale=0.002, size=z.shape)
+    vertices = np.stack([x, y, z], axis=-1).reshape(-1, 3) * 100.0
+
+    q, _ = np.linalg.qr(rng.normal(size=(3, 3)))
+    vertices = vertices @ q.T + rng.uniform(-500, 500, size=3)
+
+    index = np.arange(rows * cols).reshape(rows, cols)
+    a, b = index[:-1, :-1].ravel(), index[:-1, 1:].ravel()
+    c, d = index[1:, :-1].ravel(), index[1:, 1:].ravel()
+    faces = np.concatenate([np.stack([a, b, c], axis=1), np.stack([b, d, c], axis=1)])
+    write_binary_stl(file_path, vertices[faces].astype(np.float32))
+    return rows * cols
+
+
+def make_scan_project(root, n_patients, seed=0):
+    # Files as delivered in a scan project ZIP after extraction, before renaming
+    rng = np.random.default_rng(seed)
+    ids = rng.choice(np.arange(10000, 100000), size=n_patients, replace=False)
+    for i, patient_id in enumerate(ids):
+        folder = os.path.join(root, f"Scan {i % 7}", f"Batch {i % 3}") if i % 2 else os.path.join(root, f"Scan {i % 7}")
+        os.makedirs(folder, exist_ok=True)
+        day, month = rng.integers(1, 28), rng.integers(1, 12)
+        names = [f"{patient_id}.{day:02d}.{month:02d}.stl", f"{patient_id}_g.stl",
+                 f"{patient_id}.{day:02d}.{month:02d}a.stl", f"{patient_id}.png", f"{patient_id}_notes.txt"]
+        for name in names[:rng.integers(2, len(names) + 1)]:
+            # Distinct content, so the files are not dropped as byte-identical copies by merge_to_root
+            with open(os.path.join(folder, name), "wb") as f:
+                f.write(os.path.join(folder, name).encode("utf-8").ljust(256, b"x"))
+    with open(os.path.join(root, "patients.xlsx"), "wb") as f:
+        f.write(b"x")
+
+
+def make_repository(root, n_patients, seed=0):
+    # A sorted file repository as read by reporting_script
+    rng = np.random.default_rng(seed)
+    categories = ["complete_file_set", "face_mask_only", "missing_datasheet", "only_face", "missing_template"]
+    file_types = ["face_scan.stl", "mask.stl", "template.stl", "datasheet.png", "face_scan_additional.stl"]
+    ids = rng.choice(np.arange(10000, 1000000), size=n_patients, replace=False)
+    for patient_id in ids:
+        main_folder = ["1. Training", "2. Testing", "3. Outliers"][rng.integers(0, 3)]
+        folder = os.path.join(root, main_folder, categories[rng.integers(0, len(categories))], str(patient_id))
+        os.makedirs(folder, exist_ok=True)
+        for file_type in rng.choice(file_types, size=rng.integers(1, 5), replace=False):
+            open(os.path.join(folder, f"{patient_id}_{file_type}"), "wb").close()
+    unresolved = os.path.join(root, "3. Outliers", "unresolved_files")
+    os.makedirs(unresolved, exist_ok=True)
+    for i in range(n_patients // 50 + 1):
+        open(os.path.join(unresolved, f"unknown_{i}.stl"), "wb").close()
+
+
+@contextlib.contextmanager
+def network_latency(seconds):
+    # Stand-in for an SMB share: every directory listing and stat waits for a simulated round trip
+    real_scandir, real_stat = os.scandir, os.stat
+
+    def slow_scandir(*args, **kwargs):
+        time.sleep(seconds)
+        return real_scandir(*args, **kwargs)
+
+    def slow_stat(*args, **kwargs):
+        time.sleep(seconds)
+        return real_stat(*args, **kwargs)
+
+    os.scandir, os.stat = slow_scandir, slow_stat
+    try:
+        yield
+    finally:
+        os.scandir, os.stat = real_scandir, real_stat
+
+
+def measure(func, setup=None, repeat=3):
+    # Best wall time over `repeat` runs, then one more run under tracemalloc for the peak Python heap
+    times = []
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for _ in range(repeat):
+            args = setup() if setup else ()
+            start = time.perf_counter()
+            func(*args)
+            times.append(time.perf_counter() - start)
+        args = setup() if setup else ()
+        tracemalloc.start()
+        try:
+            func(*args)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return {"seconds": min(times), "mean_seconds": sum(times) / len(times), "peak_bytes": peak}
+
+
+def benchmark_scans(work_dir, sizes, repeat):
+    results = []
+    for size in sizes:
+        input_path = os.path.join(work_dir, f"scan_{size}.stl")
+        output_path = os.path.join(work_dir, f"scan_{size}_aligned.stl")
+        n_vertices = make_synthetic_scan(input_path, size)
+        points, mesh = file_processing.load_stl(input_path)
+        pca = file_processing.apply_pca(points)
+        aligned = file_processing.align_with_axis(points, pca)
+        centered = file_processing.move_center_to_origin(aligned)
+
+        stages = {
+            "load_stl": (lambda: file_processing.load_stl(input_path), None),
+            "apply_pca": (lambda: file_processing.apply_pca(points), None),
+            "align_with_axis": (lambda: file_processing.align_with_axis(points, pca), None),
+            "move_center_to_origin": (lambda: file_processing.move_center_to_origin(aligned), None),
+            "save_aligned_stl": (lambda: file_processing.save_aligned_stl(centered, mesh, output_path), None),
+            "process_file": (lambda: file_processing.process_file(input_path, output_path), None),
+            "process_file_chunked": (lambda: file_processing.process_file_chunked(input_path, output_path), None),
+        }
+        for stage, (func, setup) in stages.items():
+            result = measure(func, setup, repeat)
+            result.update({"stage": stage, "size": n_vertices,
+                           "mb_per_second": os.path.getsize(input_path) / 1e6 / result["seconds"]})
+            results.append(result)
+            print(f"{stage:<24} {n_vertices:>10} vertices  {result['seconds'] * 1000:10.2f} ms  "
+                  f"{result['peak_bytes'] / 1e6:8.1f} MB peak")
+    return results
+
+
+def benchmark_traversal(work_dir, patient_counts, repeat, latency):
+    results = []
+    for n_patients in patient_counts:
+        repository = os.path.join(work_dir, f"traversal_{n_patients}")
+        make_repository(repository, n_patients)
+        stages = {
+            "os_walk": lambda: sum(1 for _ in os.walk(repository)),
+            "walk_concurrent": lambda: sum(1 for _ in traversal.walk_concurrent(repository)),
+        }
+        with network_latency(latency):
+            for stage, func in stages.items():
+                result = measure(func, None, repeat)
+                result.update({"stage": stage, "size": n_patients, "latency_seconds": latency})
+                results.append(result)
+                print(f"{stage:<24} {n_patients:>10} patients  {result['seconds'] * 1000:10.2f} ms  "
+                      f"({latency * 1000:.1f} ms per call)")
+    return results
+
+
+def benchmark_files(work_dir, patient_counts, repeat):
+    results = []
+    for n_patients in patient_counts:
+        template = os.path.join(work_dir, f"project_{n_patients}")
+        make_scan_project(template, n_patients)
+        processing = os.path.join(work_dir, f"processing_{n_patients}")
+
+        def fresh_copy(steps=()):
+            shutil.rmtree(processing, ignore_errors=True)
+            shutil.copytree(template, processing)
+            for step in steps:
+                step(processing)
+            return (processing,)
+
+        renamed = (new_files_script.rename_all_subfolders,)
+        merged = renamed + (new_files_script.merge_to_root,)
+        stages = {
+            "rename_stl_files": (new_files_script.rename_all_subfolders, fresh_copy),
+            "merge_to_root": (new_files_script.merge_to_root, lambda: fresh_copy(renamed)),
+            "group_files_by_id": (new_files_script.group_files_by_id, lambda: fresh_copy(merged)),
+        }
+
+        repository = os.path.join(work_dir, f"repository_{n_patients}")
+        make_repository(repository, n_patients)
+
+        def cold_index():
+            file_index._loaded_indexes.clear()
+            index_path = os.path.join(repository, file_index.INDEX_FILENAME)
+            if os.path.exists(index_path):
+                os.remove(index_path)
+            return (repository,)
+
+        def warm_index():
+            file_index._loaded_indexes.clear()
+            file_index.get_file_index(repository)
+            file_index._loaded_indexes.clear()
+            return (repository,)
+
+        def report_counters(directory):
+            reporting_script.map_folders(directory)
+            reporting_script.count_unresolved_files(directory)
+            for counter in (reporting_script.total_face_scans, reporting_script.total_masks,
+                            reporting_script.total_templates, reporting_script.total_datasheet,
+                            reporting_script.total_additional):
+                counter(directory)
+
+        stages["report_counters_cold"] = (report_counters, cold_index)
+        stages["report_counters_warm"] = (report_counters, warm_index)
+
+        for stage, (func, setup) in stages.items():
+            result = measure(func, setup, repeat)
+            result.update({"stage": stage, "size": n_patients})
+            results.append(result)
+            print(f"{stage:<24} {n_patients:>10} patients  {result['seconds'] * 1000:10.2f} ms  "
+                  f"{result['peak_bytes'] / 1e6:8.1f} MB peak")
+    return results
+
+
+def compare_results(results, baseline_path):
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = {(r["stage"], r["size"]): r for r in json.load(f)["results"]}
+    print(f"\nComparison with {baseline_path} (new / old):")
+    for result in results:
+        old = baseline.get((result["stage"], result["size"]))
+        if old:
+            ratio = result["seconds"] / old["seconds"] if old["seconds"] else float("inf")
+            flag = "  <-- slower" if ratio > 1.2 else ""
+            print(f"{result['stage']:<24} {result['size']:>10}  {ratio:6.2f}x{flag}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark every stage of the pipeline on synthetic data.")
+    parser.add_argument("--sizes", default="10000,100000,1000000",
+                        help="comma-separated vertex counts of the synthetic scans")
+    parser.add_argument("--patients", default="100,1000", help="comma-separated patient counts of the synthetic trees")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per stage (the best one is kept)")
+    parser.add_argument("--output", default="benchmark_results.json", help="where to write the JSON results")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    parser.add_argument("--latency-ms", type=float, default=2.0,
+                        help="simulated network latency per directory call in the traversal benchmark")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",") if size]
+    patient_counts = [int(count) for count in args.patients.split(",") if count]
+    with tempfile.TemporaryDirectory(prefix="pipeline_benchmark_") as work_dir:
+        results = benchmark_scans(work_dir, sizes, args.repeat)
+        results += benchmark_files(work_dir, patient_counts, args.repeat)
+        results += benchmark_traversal(work_dir, patient_counts, args.repeat, args.latency_ms / 1000)
+
+    output = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(output, f, indent=2)
+    print(f"\nResults written to {args.output}")
+
+    if args.compare:
+        compare_results(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
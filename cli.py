@@ -0,0 +1,162 @@
+import argparse
+import json
+import os
+import sys
+
+
+# Optional JSON file with default values for the options, e.g. {"processed_folder": "D:/Processed", "workers": 8}
+CONFIG_ENV = "PIPELINE_CONFIG"
+
+REPOSITORY_ROOT = os.path.dirname(os.path.abspath(__file__))
+DEMO_DIR = os.path.join(REPOSITORY_ROOT, "Demo")
+
+# Each command imports what it needs when it runs, so `--help`, `rename` and `report` do not pay for
+# numpy, trimesh or pandas
+
+
+def load_config(config_path):
+    if not config_path:
+        return {}
+    with open(config_path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def use_demo_modules():
+    if DEMO_DIR not in sys.path:
+        sys.path.insert(0, DEMO_DIR)
+
+
+def run_ingest(args):
+    from new_files_script import handle_new_files
+    is_zip = args.input.lower().endswith(".zip")
+    if args.dry_run and (args.from_grouping or not is_zip):
+        sys.exit("ingest: --dry-run only works for a ZIP archive (it prints the streaming plan)")
+    # Only the streaming ingest can print its plan without touching the files, so --dry-run implies --streaming
+    handle_new_files(args.input, is_zip=is_zip, start_from_grouping=args.from_grouping,
+                     streaming=args.streaming or args.dry_run, workers=args.workers or 4, dry_run=args.dry_run,
+                     dedup=not args.no_dedup)
+
+
+def run_rename(args):
+    from renaming_script import rename_stl_files
+    rename_stl_files(args.directory, args.report)
+
+
+def run_process(args):
+    use_demo_modules()
+    from main import run_pipeline
+    run_pipeline(args.original_folder, args.processed_folder, args.workers, args.chunked, args.lod_voxel_size,
+                 args.dataset_store)
+
+
+def run_organize(args):
+    use_demo_modules()
+    from pathlib import Path
+    from file_organizing import organize_files, rename_files
+    from manifest import next_index, open_manifest
+
+    processed_folder = Path(args.processed_folder)
+    start_index = args.start_index
+    if start_index is None:
+        manifest = open_manifest(processed_folder)
+        start_index = next_index(manifest, processed_folder)
+        manifest.close()
+    final_filepaths = organize_files(rename_files(processed_folder, start_index), processed_folder)
+    print(f"Organized {len(final_filepaths)} files")
+
+
+def run_report(args):
+    from reporting_script import main
+    main(args.directory, args.output, args.formats or ("tex", "csv", "json"))
+
+
+def run_watch(args):
+    from watch_folder import watch
+    watch(args.inbox, args.processed_folder, args.workers or 2, args.queue_size, args.poll_interval,
+          args.settle_seconds, args.once)
+
+
+# For each command: the handler, and the options whose value may come from the config file (None if required)
+COMMANDS = {
+    "ingest": (run_ingest, {"input": None}),
+    "rename": (run_rename, {"directory": None, "report": ""}),
+    "process": (run_process, {"original_folder": None, "processed_folder": None, "workers": "",
+                              "lod_voxel_size": "", "dataset_store": ""}),
+    "organize": (run_organize, {"processed_folder": None}),
+    "report": (run_report, {"directory": None, "output": ""}),
+    "watch": (run_watch, {"inbox": None, "processed_folder": None, "workers": ""}),
+}
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="cli.py", description="KI-Assistenz scan pipeline.")
+    parser.add_argument("--config", default=os.environ.get(CONFIG_ENV),
+                        help=f"JSON file with default option values (default: ${CONFIG_ENV})")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    ingest = subparsers.add_parser("ingest", help="rename, merge and group a new scan project (ZIP or folder)")
+    ingest.add_argument("input", nargs="?", help="ZIP archive, unzipped folder, or folder to group")
+    ingest.add_argument("--from-grouping", action="store_true", help="only group the files of the folder by ID")
+    ingest.add_argument("--streaming", action="store_true", help="extract each file straight to its final place")
+    ingest.add_argument("--workers", type=int, help="extraction threads in streaming mode")
+    ingest.add_argument("--dry-run", action="store_true", help="print the streaming plan of a ZIP archive without extracting (implies --streaming)")
+    ingest.add_argument("--no-dedup", action="store_true", help="keep byte-identical copies as _additional files")
+
+    rename = subparsers.add_parser("rename", help="rename the STL files of one folder to the repository convention")
+    rename.add_argument("directory", nargs="?", help="folder with the files to rename")
+    rename.add_argument("--report", help="write the renames to this JSON or CSV file")
+
+    process = subparsers.add_parser("process", help="align new scans and file them by date")
+    process.add_argument("--original-folder", help="folder with the original STL files")
+    process.add_argument("--processed-folder", help="folder where the processed files are organized")
+    process.add_argument("--workers", type=int, help="worker processes (default: all CPUs)")
+    process.add_argument("--chunked", action="store_true", help="align the scans out of core")
+    process.add_argument("--lod-voxel-size", type=float, help="save level-of-detail point clouds with this voxel size")
+    process.add_argument("--dataset-store", help="append the new scans to this packed dataset store")
+
+    organize = subparsers.add_parser("organize", help="number processed files and move them into YY.MM folders")
+    organize.add_argument("--processed-folder", help="folder with the processed files")
+    organize.add_argument("--start-index", type=int, help="first number (default: next free one)")
+
+    report = subparsers.add_parser("report", help="summarize the file repository")
+    report.add_argument("directory", nargs="?", help="root of the file repository")
+    report.add_argument("--output", help="also write the report to this folder")
+    report.add_argument("--format", dest="formats", action="append", choices=("tex", "csv", "json"),
+                        help="format to write (repeatable, default: all)")
+
+    watch = subparsers.add_parser("watch", help="ingest new ZIP archives and STL scans dropped into an inbox")
+    watch.add_argument("--inbox", help="folder to watch")
+    watch.add_argument("--processed-folder", help="folder where the aligned STL scans are organized")
+    watch.add_argument("--workers", type=int, help="files handled at once")
+    watch.add_argument("--queue-size", type=int, default=4, help="settled files waiting for a worker")
+    watch.add_argument("--poll-interval", type=float, default=2.0, help="seconds between inbox scans")
+    watch.add_argument("--settle-seconds", type=float, default=5.0,
+                       help="seconds a file must stay unchanged before it is handled")
+    watch.add_argument("--once", action="store_true", help="handle the files in the inbox, then exit")
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    config = load_config(args.config)
+    handler, options = COMMANDS[args.command]
+    for name, fallback in options.items():
+        if getattr(args, name) is None:
+            value = config.get(name, fallback)
+            if value is None:
+                parser.error(f"{args.command}: --{name.replace('_', '-')} is required (or set it in the config file)")
+            setattr(args, name, value or None)
+
+    import instrumentation
+    # Set PIPELINE_METRICS (and optionally PIPELINE_PROFILE) to collect per-stage metrics
+    instrumentation.enable_from_environment()
+    try:
+        handler(args)
+    except KeyboardInterrupt:
+        print("Stopped.")
+    instrumentation.finish()
+
+
+if __name__ == "__main__":
+    main()
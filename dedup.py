@@ -0,0 +1,123 @@
+import filecmp
+import hashlib
+import json
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from traversal import DEFAULT_WORKERS
+
+
+HASH_INDEX_FILENAME = ".content_hashes.json"
+HASH_INDEX_VERSION = 1
+HASH_CHUNK_SIZE = 1 << 20
+ADDITIONAL_PATTERN = re.compile(r"(_additional)+(?=\.[^.]*$|$)")
+
+
+def hash_file(path, chunk_size=HASH_CHUNK_SIZE):
+    # hashlib releases the GIL on large updates, so several files can be hashed at once in threads
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cache_key(path, stat):
+    # Moves within a volume keep the name, size and mtime, so files moved by merge/group keep their cached hash.
+    # Two files with the same name, size and mtime in different folders share a key, so a cached hash is only a
+    # hint: files are compared with same_content before one of them is deleted.
+    return f"{os.path.basename(path)}|{stat.st_size}|{stat.st_mtime_ns}"
+
+
+def same_content(path, other_path):
+    return filecmp.cmp(path, other_path, shallow=False)
+
+
+def load_hash_index(index_path):
+    if os.path.isfile(index_path):
+        try:
+            with open(index_path, encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == HASH_INDEX_VERSION:
+                return data["hashes"]
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Warning: ignoring unreadable hash index {index_path}: {e}")
+    return {}
+
+
+def save_hash_index(index_path, hashes):
+    try:
+        temp_path = index_path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": HASH_INDEX_VERSION, "hashes": hashes}, f)
+        os.replace(temp_path, index_path)
+    except OSError as e:
+        print(f"Warning: could not save hash index {index_path}: {e}")
+
+
+def hash_files(paths, hashes=None, workers=DEFAULT_WORKERS):
+    # Returns the hash of every path, reusing the cached ones and hashing the others in parallel.
+    # New hashes are added to `hashes`, which maps cache keys to hashes.
+    hashes = {} if hashes is None else hashes
+    keys = [cache_key(path, os.stat(path)) for path in paths]
+    missing = sorted({(key, path) for key, path in zip(keys, paths) if key not in hashes})
+    if missing:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for (key, _), digest in zip(missing, executor.map(hash_file, [path for _, path in missing])):
+                hashes[key] = digest
+    return [hashes[key] for key in keys]
+
+
+def remember_hash(hashes, path, digest):
+    hashes[cache_key(path, os.stat(path))] = digest
+
+
+def prune_hash_index(hashes, paths):
+    # Keeps only the entries of files that still exist, so the index does not grow with every batch
+    live_keys = {cache_key(path, os.stat(path)) for path in paths}
+    for key in set(hashes) - live_keys:
+        del hashes[key]
+
+
+def original_name(filename):
+    return ADDITIONAL_PATTERN.sub("", filename)
+
+
+def split_additional_files(directory, index_dirs, workers=DEFAULT_WORKERS):
+    # Sorts the "_additional" files of a repository into genuine extra scans and byte-identical copies of
+    # another file of the same chain. Only files with the size of a sibling in the chain are hashed.
+    hash_index_path = os.path.join(directory, HASH_INDEX_FILENAME)
+    hashes = load_hash_index(hash_index_path)
+    candidates = []
+    for relative_path, entry in index_dirs.items():
+        chains = {}
+        for file in entry["files"]:
+            chains.setdefault(original_name(file), []).append(file)
+        for chain in chains.values():
+            if not any("additional" in file for file in chain):
+                continue
+            paths = [os.path.join(directory, relative_path, file) for file in chain]
+            sizes = [os.path.getsize(path) for path in paths] if len(chain) > 1 else [None]
+            for file, path, size in zip(chain, paths, sizes):
+                if "additional" in file:
+                    same_size = [other for other, other_size in zip(paths, sizes) if other_size == size and other != path]
+                    candidates.append((entry["patient_id"], relative_path, file, path, same_size))
+
+    to_hash = set()
+    for *_, path, same_size in candidates:
+        if same_size:
+            to_hash.add(path)
+            to_hash.update(same_size)
+    to_hash = sorted(to_hash)
+    digests = dict(zip(to_hash, hash_files(to_hash, hashes, workers)))
+    if to_hash:
+        save_hash_index(hash_index_path, hashes)
+
+    additional, duplicates = [], []
+    for patient_id, relative_path, file, path, same_size in candidates:
+        # A chain of identical copies keeps its shortest name as the original
+        is_copy = any(digests[other] == digests[path] and len(os.path.basename(other)) < len(file)
+                      for other in same_size)
+        (duplicates if is_copy else additional).append((patient_id, os.path.join(relative_path, file)))
+    return additional, duplicates
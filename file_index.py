@@ -0,0 +1,84 @@
+import json
+import os
+import re
+
+from traversal import DEFAULT_WORKERS, join_relative, list_directory, traverse
+
+
+INDEX_FILENAME = ".file_index.json"
+INDEX_VERSION = 1
+ID_PATTERN = re.compile(r"\d{5,6}")
+
+# Indexes already loaded in this process, by repository directory
+_loaded_indexes = {}
+
+
+def update_file_index(directory, cached_dirs=None, workers=DEFAULT_WORKERS):
+    # Only directories whose mtime changed are listed again; the others reuse the cached entry
+    cached_dirs = cached_dirs or {}
+
+    def visit(relative_path):
+        path = join_relative(directory, relative_path)
+        mtime_ns = os.stat(path).st_mtime_ns
+        entry = cached_dirs.get(relative_path)
+        if entry is None or entry["mtime_ns"] != mtime_ns:
+            dirs, files = list_directory(path)
+            match = ID_PATTERN.search(path)
+            entry = {
+                "mtime_ns": mtime_ns,
+                "patient_id": match.group() if match else None,
+                "files": files,
+                "dirs": dirs,
+            }
+        return entry, entry["dirs"]
+
+    return dict(traverse(directory, visit, workers))
+
+
+def load_file_index(directory, index_path=None):
+    index_path = index_path or os.path.join(directory, INDEX_FILENAME)
+    cached_dirs = {}
+    if os.path.isfile(index_path):
+        try:
+            with open(index_path, encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == INDEX_VERSION and data.get("root") == directory:
+                cached_dirs = data["dirs"]
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Warning: ignoring unreadable file index {index_path}: {e}")
+
+    index_dirs = update_file_index(directory, cached_dirs)
+
+    try:
+        temp_path = index_path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": INDEX_VERSION, "root": directory, "dirs": index_dirs}, f)
+        os.replace(temp_path, index_path)
+    except OSError as e:
+        print(f"Warning: could not save file index {index_path}: {e}")
+    return index_dirs
+
+
+def get_file_index(directory):
+    # Walks (or refreshes) the repository once per process and serves every later query from memory
+    if directory not in _loaded_indexes:
+        _loaded_indexes[directory] = load_file_index(directory)
+    return _loaded_indexes[directory]
+
+
+def list_subdirectories(directory, relative_path):
+    entry = get_file_index(directory).get(relative_path)
+    return None if entry is None else entry["dirs"]
+
+
+def list_files(directory, relative_path):
+    entry = get_file_index(directory).get(relative_path)
+    return None if entry is None else entry["files"]
+
+
+def ids_with_file(directory, keyword):
+    matching_ids = set()
+    for entry in get_file_index(directory).values():
+        if entry["patient_id"] and any(keyword in file for file in entry["files"]):
+            matching_ids.add(entry["patient_id"])
+    return sorted(matching_ids)
@@ -0,0 +1,208 @@
+import contextlib
+import functools
+import json
+import os
+import time
+
+
+# Set with PIPELINE_METRICS=<path of the JSON-lines file> and PIPELINE_PROFILE=cprofile,tracemalloc
+METRICS_ENV = "PIPELINE_METRICS"
+PROFILE_ENV = "PIPELINE_PROFILE"
+
+_NULL_CONTEXT = contextlib.nullcontext()
+
+_state = {
+    "enabled": False,
+    "metrics_path": None,
+    "profiler": None,
+    "trace_memory": False,
+    "started": None,
+    "current": None,
+    "records": [],
+}
+
+
+def enable(metrics_path=None, profile=False, trace_memory=False):
+    _state.update(enabled=True, metrics_path=metrics_path, trace_memory=trace_memory,
+                  started=time.perf_counter(), current=None, records=[])
+    # cProfile and tracemalloc are imported only when used, so importing this module stays cheap
+    if profile:
+        import cProfile
+        _state["profiler"] = cProfile.Profile()
+        _state["profiler"].enable()
+    if trace_memory:
+        import tracemalloc
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+
+def reset():
+    # Disables instrumentation without writing anything; used as the initializer of worker processes, which
+    # inherit the state of the parent (its metrics file and profiler) when they are forked
+    if _state["profiler"]:
+        _state["profiler"].disable()
+    _state.update(enabled=False, metrics_path=None, profiler=None, trace_memory=False, started=None, current=None,
+                  records=[])
+
+
+def enable_from_environment():
+    metrics_path = os.environ.get(METRICS_ENV)
+    if metrics_path:
+        modes = os.environ.get(PROFILE_ENV, "").split(",")
+        enable(metrics_path, profile="cprofile" in modes, trace_memory="tracemalloc" in modes)
+
+
+def is_enabled():
+    return _state["enabled"]
+
+
+def _new_record(label):
+    return {"file": str(label), "seconds": 0.0, "stages": {}, "counters": {}}
+
+
+def _active_record():
+    # Stages outside of file_metrics (e.g. a whole report) are collected in a record of their own
+    if _state["current"] is None:
+        _state["current"] = _new_record("run")
+        _state["records"].append(_state["current"])
+    return _state["current"]
+
+
+def stage(name):
+    if not _state["enabled"]:
+        return _NULL_CONTEXT
+    return _timed_stage(name)
+
+
+@contextlib.contextmanager
+def _timed_stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stages = _active_record()["stages"]
+        stages[name] = stages.get(name, 0.0) + time.perf_counter() - start
+
+
+def timed(name):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _state["enabled"]:
+                return func(*args, **kwargs)
+            with _timed_stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name, amount=1):
+    if _state["enabled"]:
+        counters = _active_record()["counters"]
+        counters[name] = counters.get(name, 0) + amount
+
+
+def count_file_bytes(name, file_path):
+    if _state["enabled"] and os.path.isfile(file_path):
+        count(name, os.path.getsize(file_path))
+
+
+@contextlib.contextmanager
+def file_metrics(label):
+    if not _state["enabled"]:
+        yield None
+        return
+
+    previous = _state["current"]
+    record = _state["current"] = _new_record(label)
+    if _state["trace_memory"]:
+        import tracemalloc
+        tracemalloc.reset_peak()
+    start = time.perf_counter()
+    try:
+        yield record
+    except Exception as e:
+        record["error"] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        record["seconds"] = time.perf_counter() - start
+        if _state["trace_memory"]:
+            import tracemalloc
+            record["peak_memory_bytes"] = tracemalloc.get_traced_memory()[1]
+        _state["current"] = previous
+        add_record(record)
+
+
+def add_record(record):
+    # Also used for records measured in worker processes
+    if not _state["enabled"]:
+        return
+    _state["records"].append(record)
+    if _state["metrics_path"]:
+        with open(_state["metrics_path"], "a", encoding="utf-8") as f:
+            f.write(json.dumps(record) + "\n")
+
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(int(round(fraction * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def summarize():
+    records = [record for record in _state["records"] if record["file"] != "run"]
+    elapsed = time.perf_counter() - _state["started"] if _state["started"] else 0.0
+    counters = {}
+    stage_times = {}
+    for record in _state["records"]:
+        for name, value in record["counters"].items():
+            counters[name] = counters.get(name, 0) + value
+        for name, seconds in record["stages"].items():
+            stage_times.setdefault(name, []).append(seconds)
+
+    stages = {}
+    for name, values in stage_times.items():
+        values.sort()
+        stages[name] = {"count": len(values), "total_seconds": sum(values),
+                        "p50_seconds": _percentile(values, 0.5), "p95_seconds": _percentile(values, 0.95)}
+
+    return {
+        "files": len(records),
+        "errors": sum(1 for record in records if "error" in record),
+        "elapsed_seconds": elapsed,
+        "scans_per_second": len(records) / elapsed if elapsed else None,
+        "read_mb_per_second": counters.get("bytes_read", 0) / 1e6 / elapsed if elapsed else None,
+        "written_mb_per_second": counters.get("bytes_written", 0) / 1e6 / elapsed if elapsed else None,
+        "counters": counters,
+        "stages": stages,
+    }
+
+
+def finish():
+    if not _state["enabled"]:
+        return None
+
+    summary = summarize()
+    if _state["metrics_path"]:
+        with open(_state["metrics_path"], "a", encoding="utf-8") as f:
+            f.write(json.dumps({"summary": summary}) + "\n")
+    if _state["profiler"]:
+        _state["profiler"].disable()
+        profile_path = (_state["metrics_path"] or "pipeline") + ".prof"
+        _state["profiler"].dump_stats(profile_path)
+        print(f"Profile written to {profile_path}")
+    if _state["trace_memory"]:
+        import tracemalloc
+        tracemalloc.stop()
+
+    print(f"\nProcessed {summary['files']} files in {summary['elapsed_seconds']:.2f} s"
+          f" ({summary['errors']} errors, {summary['scans_per_second'] or 0:.2f} scans/s,"
+          f" {summary['read_mb_per_second'] or 0:.2f} MB/s read, {summary['written_mb_per_second'] or 0:.2f} MB/s written)")
+    for name, value in summary["counters"].items():
+        print(f"  {name:<20} {value}")
+    for name, values in summary["stages"].items():
+        print(f"  {name:<20} total {values['total_seconds']:8.3f} s"
+              f"  p50 {values['p50_seconds'] * 1000:8.2f} ms  p95 {values['p95_seconds'] * 1000:8.2f} ms")
+    _state.update(enabled=False, profiler=None, trace_memory=False)
+    return summary
@@ -1,49 +1,115 @@
+import hashlib
 import os
 import zipfile
 import shutil
 import re
-import importlib.util
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-spec = importlib.util.spec_from_file_location("renaming_script", "renaming_script.py")
-renaming_script = importlib.util.module_from_spec(spec)
-spec.loader.exec_module(renaming_script)
+import instrumentation
+import renaming_script
+from dedup import (HASH_INDEX_FILENAME, hash_files, load_hash_index, prune_hash_index, remember_hash, same_content,
+                   save_hash_index)
+from instrumentation import stage
+from traversal import walk_concurrent
 
 def unzip_to_processing(zip_path, extract_to):
     with zipfile.ZipFile(zip_path, 'r') as zip_ref:
         zip_ref.extractall(extract_to)
     print(f"Unzipped to {extract_to}")
 
-def rename_all_subfolders(processing_path):
-    for item in os.listdir(processing_path):
-        item_path = os.path.join(processing_path, item)
-        if os.path.isdir(item_path):
-            for subitem in os.listdir(item_path):
-                subitem_path = os.path.join(item_path, subitem)
-                if os.path.isdir(subitem_path):
-                    renaming_script.rename_stl_files(subitem_path)
-                else:
-                    renaming_script.rename_stl_files(item_path)
-
-def merge_to_root(processing_path):
-    for root, dirs, files in os.walk(processing_path, topdown=False):
+def rename_all_subfolders(processing_path, report_path=None):
+    # Every folder with files directly inside a top-level folder, and every folder one level below, is renamed once
+    directories = []
+    with os.scandir(processing_path) as items:
+        for item in items:
+            if not item.is_dir():
+                continue
+            has_files = False
+            with os.scandir(item.path) as subitems:
+                for subitem in subitems:
+                    if subitem.is_dir():
+                        directories.append(subitem.path)
+                    else:
+                        has_files = True
+            if has_files:
+                directories.append(item.path)
+
+    report = []
+    for directory in directories:
+        report.extend(renaming_script.apply_rename_plan(renaming_script.plan_renames(directory)))
+    renaming_script.summarize_rename_report(report)
+    if report_path:
+        renaming_script.write_rename_report(report, report_path)
+    return report
+
+def is_grouped_folder(processing_path, root):
+    # Folders made by group_files_by_id in an earlier batch: one level below the root, named by a patient ID
+    return os.path.dirname(root) == processing_path and re.fullmatch(r"\d{5,6}", os.path.basename(root)) is not None
+
+def merge_to_root(processing_path, dedup=True):
+    # List all folders concurrently, then handle the deepest first like os.walk(topdown=False)
+    listing = sorted(walk_concurrent(processing_path), key=lambda item: (-item[0].count(os.sep), item[0]))
+    listing = [(root, dirs, [file for file in files if not file.startswith('.')]) for root, dirs, files in listing]
+
+    # With dedup, byte-identical copies are dropped instead of being stored again as "_additional".
+    # Files from earlier batches (in the root or grouped into ID folders) are kept over new copies.
+    hash_index_path = os.path.join(processing_path, HASH_INDEX_FILENAME)
+    hashes = load_hash_index(hash_index_path) if dedup else {}
+    digests = {}
+    kept = {}
+    if dedup:
+        paths = [os.path.join(root, file) for root, _, files in listing for file in files]
+        digests = dict(zip(paths, hash_files(paths, hashes)))
+        for root, _, files in listing:
+            if root == processing_path or is_grouped_folder(processing_path, root):
+                for file in files:
+                    kept.setdefault(digests[os.path.join(root, file)], os.path.join(root, file))
+
+    duplicates = []
+    final_paths = []
+    for root, dirs, files in listing:
         if root == processing_path:
+            final_paths.extend(os.path.join(root, file) for file in files)
             continue  # Skip the root itself
         for file in files:
             src = os.path.join(root, file)
+            if dedup:
+                original = kept.setdefault(digests[src], src)
+                if original != src and same_content(src, original):
+                    duplicates.append((src, original))
+                    os.remove(src)
+                    continue
             dst = os.path.join(processing_path, file)
             base, ext = os.path.splitext(dst)
             while os.path.exists(dst):
-                dst = f"{base}_additional{ext}"
+                base = f"{base}_additional"
+                dst = f"{base}{ext}"
             shutil.move(src, dst)
+            if dedup:
+                if kept[digests[src]] == src:
+                    kept[digests[src]] = dst
+                remember_hash(hashes, dst, digests[src])
+            final_paths.append(dst)
         # Once files are moved, remove the empty folder
         if os.path.isdir(root) and not os.listdir(root):
             os.rmdir(root)
+
+    if dedup:
+        prune_hash_index(hashes, final_paths)
+        save_hash_index(hash_index_path, hashes)
+        instrumentation.count("duplicates_skipped", len(duplicates))
+        print(f"Skipped {len(duplicates)} duplicate files (identical to a file already in Processing).")
     print("All subfolder contents moved to Processing root.")
+    return duplicates
 
 def group_files_by_id(processing_path):
-    for file in os.listdir(processing_path):
+    with os.scandir(processing_path) as entries:
+        files = [entry.name for entry in entries if entry.is_file()]
+    for file in files:
         file_path = os.path.join(processing_path, file)
-        if os.path.isfile(file_path) and not file.endswith(('.xls', '.xlsx', '.csv')):
+        if not file.endswith(('.xls', '.xlsx', '.csv')):
             match = re.match(r"(\d{5,6})", file)
             if match:
                 id_folder = os.path.join(processing_path, match.group(1))
@@ -51,24 +117,255 @@ def group_files_by_id(processing_path):
                 shutil.move(file_path, os.path.join(id_folder, file))
     print("Files grouped by ID.")
 
-def handle_new_files(input_path, is_zip=True, start_from_grouping=False):
+def grouped_folder(processing_path, filename):
+    # Same rule as group_files_by_id: files starting with an ID go to its folder, spreadsheets stay in the root
+    if not filename.endswith(('.xls', '.xlsx', '.csv')):
+        match = re.match(r"(\d{5,6})", filename)
+        if match:
+            return os.path.join(processing_path, match.group(1))
+    return processing_path
+
+
+def hash_zip_member(zip_ref, info):
+    digest = hashlib.sha256()
+    with zip_ref.open(info) as src:
+        for chunk in iter(lambda: src.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def zip_member_matches(zip_ref, info, path):
+    if os.path.getsize(path) != info.file_size:
+        return False
+    with zip_ref.open(info) as src, open(path, "rb") as f:
+        for chunk in iter(lambda: src.read(1 << 20), b""):
+            if f.read(len(chunk)) != chunk:
+                return False
+    return True
+
+
+def find_zip_duplicates(zip_ref, members, processing_path, hashes):
+    # A member can only be a copy of a file with the same size, or of an earlier member with the same size and
+    # CRC (both listed in the archive), so only those members are read and hashed
+    existing = [os.path.join(root, file) for root, _, files in walk_concurrent(processing_path)
+                for file in files if not file.startswith('.')] if os.path.isdir(processing_path) else []
+    existing_paths = set(existing)
+    existing_by_size = {}
+    for path in existing:
+        existing_by_size.setdefault(os.path.getsize(path), []).append(path)
+
+    kept = {}
+    hashed_sizes = set()
+    hashed_keys = set()
+    unhashed = {}
+    duplicates = {}
+    for info in members:
+        key = (info.file_size, info.CRC)
+        if info.file_size not in existing_by_size and key not in unhashed and key not in hashed_keys:
+            unhashed[key] = info
+            continue
+        if info.file_size in existing_by_size and info.file_size not in hashed_sizes:
+            same_size = existing_by_size[info.file_size]
+            for path, digest in zip(same_size, hash_files(same_size, hashes)):
+                kept.setdefault(digest, path)
+            hashed_sizes.add(info.file_size)
+        first = unhashed.pop(key, None)
+        if first is not None:
+            kept.setdefault(hash_zip_member(zip_ref, first), first.filename)
+        hashed_keys.add(key)
+        digest = hash_zip_member(zip_ref, info)
+        if digest not in kept:
+            kept[digest] = info.filename
+        elif kept[digest] not in existing_paths or zip_member_matches(zip_ref, info, kept[digest]):
+            # The hashes of existing files may come from the cache, so a match is confirmed against the file
+            duplicates[info.filename] = kept[digest]
+    # Maps each duplicate member to the existing path or the name of the member it is a copy of
+    return duplicates
+
+
+def plan_zip_ingest(zip_path, processing_path, hashes=None):
+    # With `hashes` (the hash index of the processing folder), byte-identical copies are planned as skipped
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        members = [info for info in zip_ref.infolist() if not info.is_dir()]
+        duplicates = {}
+        if hashes is not None:
+            ordered = sorted(members, key=lambda info: '/' in info.filename)
+            duplicates = find_zip_duplicates(zip_ref, ordered, processing_path, hashes)
+
+    # Rename the files one and two folders deep, as rename_all_subfolders does after extraction
+    folders = {}
+    for info in members:
+        folder, _, name = info.filename.rpartition('/')
+        folders.setdefault(folder, []).append((info, name))
+    new_names = {}
+    for folder, entries in folders.items():
+        depth = folder.count('/') + 1 if folder else 0
+        taken = {name for _, name in entries}
+        for info, name in entries:
+            new_name = renaming_script.new_filename_for(name) if depth in (1, 2) else None
+            if new_name and new_name not in taken:
+                taken.discard(name)
+                taken.add(new_name)
+                name = new_name
+            new_names[info.filename] = name
+
+    # Members in the root of the archive come first; every member gets "_additional" when its target is taken,
+    # by an earlier member or by a file of an earlier batch, as in merge_to_root and group_files_by_id
+    members.sort(key=lambda info: '/' in info.filename)
+    plan = []
+    targets = set()
+    for info in members:
+        if info.filename in duplicates:
+            plan.append({"member": info.filename, "target": None, "size": info.file_size,
+                         "duplicate_of": duplicates[info.filename]})
+            continue
+        name = new_names[info.filename]
+        target = os.path.join(grouped_folder(processing_path, name), name)
+        base, ext = os.path.splitext(name)
+        while target in targets or os.path.exists(target):
+            base = f"{base}_additional"
+            name = base + ext
+            target = os.path.join(grouped_folder(processing_path, name), name)
+        targets.add(target)
+        plan.append({"member": info.filename, "target": target, "size": info.file_size})
+
+    member_targets = {entry["member"]: entry["target"] for entry in plan}
+    for entry in plan:
+        if "duplicate_of" in entry:
+            entry["duplicate_of"] = member_targets.get(entry["duplicate_of"], entry["duplicate_of"])
+    return plan
+
+
+def stream_zip_to_processing(zip_path, processing_path, workers=4, dry_run=False, dedup=True):
+    journal_base = os.path.join(processing_path, f".ingest_{os.path.basename(zip_path)}")
+    plan_path = journal_base + ".plan.json"
+    done_path = journal_base + ".done"
+
+    # Resume with the plan of an interrupted run, so files it already wrote are not renamed as collisions
+    plan = None
+    if os.path.isfile(plan_path):
+        with open(plan_path, encoding="utf-8") as f:
+            saved = json.load(f)
+        if saved["zip_size"] == os.path.getsize(zip_path):
+            plan = saved["entries"]
+            print(f"Resuming interrupted ingest of {zip_path}")
+        else:
+            print(f"Discarding the plan of an interrupted ingest of another archive named {os.path.basename(zip_path)}")
+    resumed = plan is not None
+    hash_index_path = os.path.join(processing_path, HASH_INDEX_FILENAME)
+    hashes = load_hash_index(hash_index_path) if dedup else None
+    if plan is None:
+        plan = plan_zip_ingest(zip_path, processing_path, hashes)
+
+    if dry_run:
+        for entry in plan:
+            if "duplicate_of" in entry:
+                print(f"{entry['member']} skipped, identical to {os.path.relpath(entry['duplicate_of'], processing_path)}")
+            else:
+                print(f"{entry['member']} -> {os.path.relpath(entry['target'], processing_path)}")
+        return plan
+
+    os.makedirs(processing_path, exist_ok=True)
+    if not resumed:
+        # A new plan starts a new journal; the members listed in an old one belong to another archive
+        if os.path.exists(done_path):
+            os.remove(done_path)
+        with open(plan_path, "w", encoding="utf-8") as f:
+            json.dump({"zip_size": os.path.getsize(zip_path), "entries": plan}, f)
+
+    done = set()
+    if os.path.isfile(done_path):
+        with open(done_path, encoding="utf-8") as f:
+            done = set(f.read().splitlines())
+    duplicates = [entry for entry in plan if "duplicate_of" in entry]
+    pending = [entry for entry in plan if "duplicate_of" not in entry and not (
+        entry["member"] in done and os.path.isfile(entry["target"])
+        and os.path.getsize(entry["target"]) == entry["size"])]
+
+    # Each worker thread reads the archive through its own handle
+    local = threading.local()
+    handles = []
+    lock = threading.Lock()
+
+    def extract(entry):
+        if not hasattr(local, "zip_ref"):
+            local.zip_ref = zipfile.ZipFile(zip_path, 'r')
+            with lock:
+                handles.append(local.zip_ref)
+        os.makedirs(os.path.dirname(entry["target"]), exist_ok=True)
+        part_path = entry["target"] + ".part"
+        digest = hashlib.sha256()
+        with local.zip_ref.open(entry["member"]) as src, open(part_path, "wb") as dst:
+            for chunk in iter(lambda: src.read(1 << 20), b""):
+                digest.update(chunk)
+                dst.write(chunk)
+        os.replace(part_path, entry["target"])
+        with lock:
+            if hashes is not None:
+                remember_hash(hashes, entry["target"], digest.hexdigest())
+            instrumentation.count("bytes_written", entry["size"])
+            instrumentation.count("files_written")
+            with open(done_path, "a", encoding="utf-8") as f:
+                f.write(entry["member"] + "\n")
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(extract, pending))
+    finally:
+        for zip_ref in handles:
+            zip_ref.close()
+
+    if hashes is not None:
+        save_hash_index(hash_index_path, hashes)
+        instrumentation.count("duplicates_skipped", len(duplicates))
+        print(f"Skipped {len(duplicates)} duplicate files (identical to a file already in Processing).")
+    os.remove(plan_path)
+    if os.path.exists(done_path):
+        os.remove(done_path)
+    print(f"Streamed {len(pending)} files from {zip_path} to {processing_path}")
+    return plan
+
+
+def handle_new_files(input_path, is_zip=True, start_from_grouping=False, streaming=False, workers=4, dry_run=False,
+                     dedup=True):
     processing_dir = os.path.join(os.path.dirname(input_path), "Processing")
 
+    # Only the streaming ingest of a ZIP archive has a plan to print; the other paths would change the files
+    if dry_run and (start_from_grouping or not is_zip or not streaming):
+        raise ValueError("dry_run needs a ZIP archive and streaming=True")
+
     if start_from_grouping:
-        group_files_by_id(input_path)
+        with stage("group"):
+            group_files_by_id(input_path)
+        return
+
+    if is_zip:
+        instrumentation.count_file_bytes("bytes_read", input_path)
+
+    if is_zip and streaming:
+        # Rename, merge and group while extracting, writing each file once to its final place
+        with stage("stream"):
+            stream_zip_to_processing(input_path, processing_dir, workers, dry_run, dedup)
         return
 
     if is_zip:
-        unzip_to_processing(input_path, processing_dir)
+        with stage("unzip"):
+            unzip_to_processing(input_path, processing_dir)
     else:
         processing_dir = input_path
 
-    rename_all_subfolders(processing_dir)
-    merge_to_root(processing_dir)
-    group_files_by_id(processing_dir)
+    with stage("rename"):
+        rename_all_subfolders(processing_dir)
+    with stage("merge"):
+        merge_to_root(processing_dir, dedup)
+    with stage("group"):
+        group_files_by_id(processing_dir)
 
 if __name__ == "__main__":
-    handle_new_files("D:\Scanprojekt #9 H+I.zip", is_zip=True)
+    # Set PIPELINE_METRICS (and optionally PIPELINE_PROFILE) to collect per-stage metrics
+    instrumentation.enable_from_environment()
+    handle_new_files("D:\Scanprojekt #9 H+I.zip", is_zip=True, streaming=True)
+    # handle_new_files("D:\Scanprojekt #9 H+I.zip", is_zip=True, streaming=True, dry_run=True)
     # handle_new_files("path/to/unzipped/folder", is_zip=False)
     # handle_new_files("path/to/folder_with_all_files", start_from_grouping=True)
-    pass
+    instrumentation.finish()
@@ -1,38 +1,99 @@
+import csv
+import json
 import os
 import re
 
 
-def rename_stl_files(directory):
+PATTERNS = {
+    re.compile(r"^(\d{5})_g\.stl$"): "{code}_mask.stl",
+    re.compile(r"^(\d{5})\.\d{2}\.\d{2}\.stl$"): "{code}_face_scan.stl",
+    re.compile(r"^(\d{5})\.\d{2}\.\d{2}a\.stl$"): "{code}_template.stl",
+    re.compile(r"^(\d{5})\.png$"): "{code}_datasheet.png"
+}
+
+# All patterns in one regex; each alternative is a group followed directly by its code group
+COMBINED_PATTERN = re.compile("|".join(f"({pattern.pattern})" for pattern in PATTERNS))
+FORMATS = {2 * i + 1: new_format for i, new_format in enumerate(PATTERNS.values())}
+
+
+def new_filename_for(filename):
+    match = COMBINED_PATTERN.match(filename)
+    if match is None:
+        return None
+    return FORMATS[match.lastindex].format(code=match.group(match.lastindex + 1))
+
+
+def plan_renames(directory):
+    # Lists the directory once and resolves collisions against the names it will contain after each rename
+    with os.scandir(directory) as entries:
+        names = sorted(entry.name for entry in entries)
+
+    taken = set(names)
+    plan = []
+    for filename in names:
+        new_filename = new_filename_for(filename)
+        if new_filename is None:
+            status = "no_match"
+        elif new_filename in taken:
+            status = "exists"
+        else:
+            status = "rename"
+            taken.discard(filename)
+            taken.add(new_filename)
+        plan.append({"directory": directory, "old": filename, "new": new_filename, "status": status})
+    return plan
+
+
+def apply_rename_plan(plan):
+    for entry in plan:
+        if entry["status"] != "rename":
+            continue
+        try:
+            os.rename(os.path.join(entry["directory"], entry["old"]),
+                      os.path.join(entry["directory"], entry["new"]))
+            entry["status"] = "renamed"
+        except OSError as e:
+            entry["status"] = f"error: {e}"
+    return plan
+
+
+def write_rename_report(report, report_path):
+    if report_path.endswith(".csv"):
+        with open(report_path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=["directory", "old", "new", "status"])
+            writer.writeheader()
+            writer.writerows(report)
+    else:
+        with open(report_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+
+def summarize_rename_report(report):
+    counts = {}
+    for entry in report:
+        status = "error" if entry["status"].startswith("error") else entry["status"]
+        counts[status] = counts.get(status, 0) + 1
+    print(f"Renamed: {counts.get('renamed', 0)}, "
+          f"already existing: {counts.get('exists', 0)}, "
+          f"not matching any pattern: {counts.get('no_match', 0)}, "
+          f"errors: {counts.get('error', 0)}")
+
+
+def rename_stl_files(directory, report_path=None):
     if not os.path.isdir(directory):
         print(f"Error: '{directory}' is not a valid directory.")
-        return
-
-    patterns = {
-        re.compile(r"^(\d{5})_g\.stl$"): "{code}_mask.stl",
-        re.compile(r"^(\d{5})\.\d{2}\.\d{2}\.stl$"): "{code}_face_scan.stl",
-        re.compile(r"^(\d{5})\.\d{2}\.\d{2}a\.stl$"): "{code}_template.stl",
-        re.compile(r"^(\d{5})\.png$"): "{code}_datasheet.png"
-    }
+        return []
 
     try:
-        for filename in os.listdir(directory):
-            for pattern, new_format in patterns.items():
-                match = pattern.match(filename)
-                if match:
-                    new_filename = new_format.format(code=match.group(1))
-                    old_path = os.path.join(directory, filename)
-                    new_path = os.path.join(directory, new_filename)
-
-                    if not os.path.exists(new_path):
-                        os.rename(old_path, new_path)
-                        print(f"Renamed: {filename} -> {new_filename}")
-                    else:
-                        print(f"Skipping: {new_filename} already exists.")
-                    break  # Exit loop after first match
-            else:
-                print(f"Skipping: {filename} (does not match any pattern)")
-    except Exception as e:
+        report = apply_rename_plan(plan_renames(directory))
+    except OSError as e:
         print(f"Error processing files: {e}")
+        return []
+
+    summarize_rename_report(report)
+    if report_path:
+        write_rename_report(report, report_path)
+    return report
 
 
 if __name__ == "__main__":
@@ -0,0 +1,188 @@
+import csv
+import json
+import os
+from collections import namedtuple
+
+from dedup import split_additional_files
+from file_index import get_file_index
+
+
+# File types tracked per patient, in the order of the coverage columns; the first four are matched by keyword
+# in the file names like `ids_with_file`, "additional" and "duplicate" come from `split_additional_files`
+FILE_TYPES = ("face_scan", "mask", "template", "datasheet", "additional", "duplicate")
+KEYWORD_TYPES = FILE_TYPES[:4]
+TYPE_BITS = {file_type: 1 << i for i, file_type in enumerate(FILE_TYPES)}
+
+# Sections of the totals, as printed by reporting_script
+TOTAL_SECTIONS = (
+    ("Patient IDs", None),
+    ("Face Scans", ("face_scan",)),
+    ("Masks", ("mask",)),
+    ("Templates", ("template",)),
+    ("Datasheets", ("datasheet",)),
+    ("Additional", ("additional",)),
+)
+
+UNRESOLVED_PATH = os.path.join("3. Outliers", "unresolved_files")
+
+# Everything a report shows, computed once from the file index. `coverage` maps each patient ID to a bit mask of
+# its file types (see TYPE_BITS); `derived` holds the results of the set queries below and is the only part that
+# changes after `build_snapshot`.
+ReportSnapshot = namedtuple("ReportSnapshot", [
+    "directory", "categories", "patient_ids", "coverage", "duplicate_files", "unresolved_count", "unterkiefer_ids",
+    "derived",
+])
+
+
+def build_snapshot(directory, folder_mapping, unterkiefer_ids=()):
+    # One pass over the file index sets the keyword bits of every patient; the additional files are split into
+    # extra scans and copies once
+    index_dirs = get_file_index(directory)
+    coverage = {}
+    for entry in index_dirs.values():
+        patient_id = entry["patient_id"]
+        if not patient_id:
+            continue
+        bits = coverage.get(patient_id, 0)
+        for file in entry["files"]:
+            for file_type in KEYWORD_TYPES:
+                if file_type in file:
+                    bits |= TYPE_BITS[file_type]
+        coverage[patient_id] = bits
+
+    additional, duplicates = split_additional_files(directory, index_dirs)
+    for file_type, files in (("additional", additional), ("duplicate", duplicates)):
+        for patient_id, _ in files:
+            if patient_id:
+                coverage[patient_id] = coverage.get(patient_id, 0) | TYPE_BITS[file_type]
+
+    categories = tuple((category, tuple(ids)) for category, ids in folder_mapping.items())
+    patient_ids = tuple(sorted({patient_id for _, ids in categories for patient_id in ids}))
+    for patient_id in patient_ids:
+        coverage.setdefault(patient_id, 0)
+
+    unresolved = index_dirs.get(UNRESOLVED_PATH)
+    return ReportSnapshot(directory, categories, patient_ids, coverage, tuple(duplicates),
+                          len(unresolved["files"]) if unresolved else 0, tuple(unterkiefer_ids), {})
+
+
+def _memoized(snapshot, key, compute):
+    if key not in snapshot.derived:
+        snapshot.derived[key] = compute()
+    return snapshot.derived[key]
+
+
+def _mask(file_types):
+    mask = 0
+    for file_type in file_types:
+        mask |= TYPE_BITS[file_type]
+    return mask
+
+
+def ids_with(snapshot, *file_types):
+    # Sorted IDs of the patients that have all of the given file types
+    mask = _mask(file_types)
+    return _memoized(snapshot, ("with", mask), lambda: tuple(sorted(
+        patient_id for patient_id, bits in snapshot.coverage.items() if bits & mask == mask)))
+
+
+def ids_without(snapshot, *file_types):
+    # Sorted IDs of the patients that have none of the given file types
+    mask = _mask(file_types)
+    return _memoized(snapshot, ("without", mask), lambda: tuple(sorted(
+        patient_id for patient_id, bits in snapshot.coverage.items() if not bits & mask)))
+
+
+def category_of(snapshot):
+    # Categories of each patient ID (a patient can be in more than one)
+    def compute():
+        categories = {}
+        for category, ids in snapshot.categories:
+            for patient_id in ids:
+                categories.setdefault(patient_id, []).append(category)
+        return categories
+    return _memoized(snapshot, ("category_of",), compute)
+
+
+def total_sections(snapshot):
+    for title, file_types in TOTAL_SECTIONS:
+        yield title, snapshot.patient_ids if file_types is None else ids_with(snapshot, *file_types)
+
+
+def duplicate_ids(snapshot):
+    return ids_with(snapshot, "duplicate")
+
+
+def latex_escape(text):
+    return text.replace("\\", "\\textbackslash{}").replace("_", "\\_").replace("&", "\\&").replace("%", "\\%")
+
+
+def write_latex_table(id_list, out, columns=9):
+    out.write("\\begin{longtable}{|*{%d}{>{\\centering\\arraybackslash}p{1.3cm}|}}\\hline\n" % columns)
+    for i in range(0, len(id_list), columns):
+        out.write(" & ".join(map(str, id_list[i:i + columns])))
+        out.write(" \\\\ \n")
+    out.write("\\hline \\end{longtable}")
+
+
+def write_latex(snapshot, out, columns=9):
+    # Totals first, then one table per category
+    for title, ids in total_sections(snapshot):
+        out.write(f"\\subsection*{{Total {latex_escape(title)}: {len(ids)}}}\n")
+        write_latex_table(ids, out, columns)
+        out.write("\n\n")
+    out.write(f"\\subsection*{{Duplicate Files: {len(snapshot.duplicate_files)} in {len(duplicate_ids(snapshot))} IDs}}\n")
+    write_latex_table(duplicate_ids(snapshot), out, columns)
+    out.write("\n\n")
+    out.write(f"Unresolved files: {snapshot.unresolved_count}\n\n")
+    for category, ids in snapshot.categories:
+        out.write(f"\\subsection*{{{latex_escape(category)}: {len(ids)} IDs}}\n")
+        write_latex_table(sorted(ids), out, columns)
+        out.write("\n\n")
+
+
+def write_csv(snapshot, out):
+    # The coverage matrix: one row per patient, with a 0/1 column per file type
+    writer = csv.writer(out)
+    writer.writerow(("patient_id", "categories") + FILE_TYPES)
+    categories = category_of(snapshot)
+    for patient_id in sorted(snapshot.coverage):
+        bits = snapshot.coverage[patient_id]
+        writer.writerow((patient_id, ";".join(categories.get(patient_id, ())))
+                        + tuple(int(bool(bits & TYPE_BITS[file_type])) for file_type in FILE_TYPES))
+
+
+def write_json(snapshot, out):
+    # Written piece by piece; the coverage matrix takes one line per patient
+    out.write("{\n")
+    out.write(f' "directory": {json.dumps(snapshot.directory)},\n')
+    out.write(f' "unresolved_count": {snapshot.unresolved_count},\n')
+    out.write(f' "unterkiefer_ids": {json.dumps(list(snapshot.unterkiefer_ids), default=str)},\n')
+    out.write(' "totals": {')
+    for i, (title, ids) in enumerate(total_sections(snapshot)):
+        out.write(f'{"," if i else ""}\n  {json.dumps(title)}: {json.dumps(ids)}')
+    out.write(f',\n  "Duplicate Files": {json.dumps([path for _, path in snapshot.duplicate_files])}\n }},\n')
+    out.write(' "categories": {')
+    for i, (category, ids) in enumerate(snapshot.categories):
+        out.write(f'{"," if i else ""}\n  {json.dumps(category)}: {json.dumps(sorted(ids))}')
+    out.write(f'\n }},\n "file_types": {json.dumps(FILE_TYPES)},\n "coverage": {{')
+    for i, patient_id in enumerate(sorted(snapshot.coverage)):
+        bits = snapshot.coverage[patient_id]
+        row = [int(bool(bits & TYPE_BITS[file_type])) for file_type in FILE_TYPES]
+        out.write(f'{"," if i else ""}\n  {json.dumps(patient_id)}: {json.dumps(row)}')
+    out.write("\n }\n}\n")
+
+
+RENDERERS = {"tex": write_latex, "csv": write_csv, "json": write_json}
+
+
+def write_reports(snapshot, output_dir, formats=tuple(RENDERERS)):
+    # Every format is rendered from the same snapshot, so the repository is read only once
+    os.makedirs(output_dir, exist_ok=True)
+    paths = []
+    for file_format in formats:
+        path = os.path.join(output_dir, f"report.{file_format}")
+        with open(path, "w", encoding="utf-8", newline="") as out:
+            RENDERERS[file_format](snapshot, out)
+        paths.append(path)
+    return paths
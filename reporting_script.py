@@ -1,6 +1,15 @@
+import hashlib
+import io
+import json
 import os
-import pandas as pd
 import re
+from concurrent.futures import ProcessPoolExecutor
+
+import instrumentation
+from instrumentation import stage
+from dedup import split_additional_files
+from file_index import get_file_index, ids_with_file, list_files, list_subdirectories
+from report_engine import RENDERERS, build_snapshot, duplicate_ids, total_sections, write_latex_table, write_reports
 
 
 def map_folders(directory):
@@ -10,20 +19,18 @@ def map_folders(directory):
 
     for main_folder in main_folders:
         main_path = os.path.join(directory, main_folder)
-        if not os.path.isdir(main_path):
+        category_names = list_subdirectories(directory, main_folder)
+        if category_names is None:
             print(f"Warning: {main_path} is not a valid directory.")
             continue
 
-        for category in os.listdir(main_path):
-            category_path = os.path.join(main_path, category)
-            if os.path.isdir(category_path):
-                categories.add(category)
-                folder_mapping[category] = []
+        for category in category_names:
+            categories.add(category)
+            folder_mapping[category] = []
 
-                for patient_id in os.listdir(category_path):
-                    patient_path = os.path.join(category_path, patient_id)
-                    if os.path.isdir(patient_path) and re.match(r"\d{5,6}$", patient_id):
-                        folder_mapping[category].append(patient_id)
+            for patient_id in list_subdirectories(directory, os.path.join(main_folder, category)):
+                if re.match(r"\d{5,6}$", patient_id):
+                    folder_mapping[category].append(patient_id)
 
     print("Categories Found:")
     for cat in sorted(categories):
@@ -32,27 +39,90 @@ def map_folders(directory):
     return folder_mapping
 
 
+UNTERKIEFER_CACHE_DIR = ".unterkiefer_cache"
+
+
+# pandas takes most of the start-up time, so it is imported only by the functions that read spreadsheets
+def read_spreadsheet(file_path):
+    import pandas as pd
+    if file_path.endswith('.csv'):
+        df = pd.read_csv(file_path)
+    else:
+        df = pd.read_excel(file_path)
+    return df.drop_duplicates()
+
+
+def read_spreadsheet_safely(file_path):
+    try:
+        return read_spreadsheet(file_path), None
+    except Exception as e:
+        return None, e
+
+
+def load_cached_spreadsheets(unterkiefer_path, files, workers=None):
+    import pandas as pd
+    # Parsed sheets are cached as pickles keyed by file name, size and mtime; only changed files are parsed again
+    cache_dir = os.path.join(unterkiefer_path, UNTERKIEFER_CACHE_DIR)
+    index_path = os.path.join(cache_dir, "index.json")
+    os.makedirs(cache_dir, exist_ok=True)
+    index = {}
+    if os.path.isfile(index_path):
+        try:
+            with open(index_path, encoding="utf-8") as f:
+                index = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Warning: ignoring unreadable spreadsheet cache index: {e}")
+
+    frames = {}
+    changed = []
+    for file in files:
+        stat = os.stat(os.path.join(unterkiefer_path, file))
+        entry = index.get(file)
+        if entry and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+            try:
+                frames[file] = pd.read_pickle(os.path.join(cache_dir, entry["cache_file"]))
+                continue
+            except Exception as e:
+                print(f"Warning: cache of {file} is unreadable, parsing it again: {e}")
+        changed.append((file, stat))
+
+    paths = [os.path.join(unterkiefer_path, file) for file, _ in changed]
+    if len(paths) > 1 and workers != 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(read_spreadsheet_safely, paths))
+    else:
+        results = [read_spreadsheet_safely(path) for path in paths]
+
+    for (file, stat), (df, error) in zip(changed, results):
+        if error is not None:
+            print(f"Error processing {file}: {error}")
+            index.pop(file, None)
+            continue
+        cache_file = hashlib.sha1(file.encode("utf-8")).hexdigest() + ".pkl"
+        df.to_pickle(os.path.join(cache_dir, cache_file))
+        index[file] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "cache_file": cache_file}
+        frames[file] = df
+
+    for file in set(index) - set(files):
+        cache_path = os.path.join(cache_dir, index.pop(file)["cache_file"])
+        if os.path.exists(cache_path):
+            os.remove(cache_path)
+    with open(index_path, "w", encoding="utf-8") as f:
+        json.dump(index, f)
+
+    return [frames[file] for file in files if file in frames]
+
+
 def process_unterkiefer(directory):
+    import pandas as pd
     unterkiefer_path = os.path.join(directory, "4. Unterkiefer Files")
     if not os.path.isdir(unterkiefer_path):
         print("Warning: Unterkiefer Files directory not found.")
         return [], pd.DataFrame()
 
     all_files = [f for f in os.listdir(unterkiefer_path) if f.endswith(('.csv', '.xls', '.xlsx'))]
-    combined_data = pd.DataFrame()
-
-    for file in all_files:
-        file_path = os.path.join(unterkiefer_path, file)
-        try:
-            if file.endswith('.csv'):
-                df = pd.read_csv(file_path)
-            else:
-                df = pd.read_excel(file_path)
-
-            df = df.drop_duplicates()
-            combined_data = pd.concat([combined_data, df], ignore_index=True)
-        except Exception as e:
-            print(f"Error processing {file}: {e}")
+    frames = load_cached_spreadsheets(unterkiefer_path, all_files)
+    combined_data = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
 
     if not combined_data.empty:
         combined_data = combined_data.drop_duplicates()
@@ -69,11 +139,11 @@ def process_unterkiefer(directory):
 
 
 def count_unresolved_files(directory):
-    unresolved_path = os.path.join(directory, "3. Outliers", "unresolved_files")
-    if not os.path.isdir(unresolved_path):
+    unresolved_files = list_files(directory, os.path.join("3. Outliers", "unresolved_files"))
+    if unresolved_files is None:
         return 0
 
-    return len([f for f in os.listdir(unresolved_path) if os.path.isfile(os.path.join(unresolved_path, f))])
+    return len(unresolved_files)
 
 
 def total_patient_ids(folder_mapping):
@@ -84,14 +154,7 @@ def total_patient_ids(folder_mapping):
 
 
 def filter_ids_by_filetype(directory, keyword):
-    matching_ids = set()
-    for root, _, files in os.walk(directory):
-        for file in files:
-            if keyword in file:
-                match = re.search(r"\d{5,6}", root)
-                if match:
-                    matching_ids.add(match.group())
-    return sorted(matching_ids)
+    return ids_with_file(directory, keyword)
 
 
 def total_face_scans(directory):
@@ -110,20 +173,30 @@ def total_datasheet(directory):
     return filter_ids_by_filetype(directory, "datasheet")
 
 
+# Additional files of each repository, split into genuine extra scans and byte-identical copies
+_additional_splits = {}
+
+
+def split_additional(directory):
+    if directory not in _additional_splits:
+        _additional_splits[directory] = split_additional_files(directory, get_file_index(directory))
+    return _additional_splits[directory]
+
+
 def total_additional(directory):
-    return filter_ids_by_filetype(directory, "additional")
+    additional, _ = split_additional(directory)
+    return sorted({patient_id for patient_id, _ in additional if patient_id})
 
 
-def format_latex_list(id_list, items_per_row=9):
-    id_list = sorted(id_list)
-    latex_str = "\\begin{longtable}{|*{9}{>{\\centering\\arraybackslash}p{1.3cm}|}}\\hline\n"
+def total_duplicates(directory):
+    _, duplicates = split_additional(directory)
+    return sorted({patient_id for patient_id, _ in duplicates if patient_id})
 
-    for i in range(0, len(id_list), items_per_row):
-        row = " & ".join(map(str, id_list[i:i + items_per_row]))
-        latex_str += row + " \\\ \n"
 
-    latex_str += "\\hline \\end{longtable}"
-    return latex_str
+def format_latex_list(id_list, items_per_row=9):
+    out = io.StringIO()
+    write_latex_table(sorted(id_list), out, items_per_row)
+    return out.getvalue()
 
 
 def print_category_summaries(folder_mapping):
@@ -141,28 +214,44 @@ def print_category_summaries(folder_mapping):
             print(format_latex_list(id_list, 9))
 
 
-def main():
-    directory = r"D:\\KI Assistenz\\File Repository_March2025\\File Repository"
-    folder_mapping = map_folders(directory)
+REPOSITORY_DIRECTORY = r"D:\\KI Assistenz\\File Repository_March2025\\File Repository"
+
+
+def main(directory=REPOSITORY_DIRECTORY, output_dir=None, formats=tuple(RENDERERS)):
+    with stage("map_folders"):
+        folder_mapping = map_folders(directory)
 
     print("\nFolder Mapping:")
     for category, ids in folder_mapping.items():
         print(f"{category}: {ids if ids else 'Empty'}")
 
-    unterkiefer_ids, unterkiefer_data = process_unterkiefer(directory)
+    with stage("unterkiefer"):
+        unterkiefer_ids, unterkiefer_data = process_unterkiefer(directory)
     print("\nUnterkiefer IDs:", unterkiefer_ids)
 
-    unresolved_count = count_unresolved_files(directory)
-    print(f"\nUnresolved Files Count: {unresolved_count}")
+    # Every total, the unresolved count and the written reports come from this one snapshot
+    with stage("snapshot"):
+        snapshot = build_snapshot(directory, folder_mapping, unterkiefer_ids)
+    print(f"\nUnresolved Files Count: {snapshot.unresolved_count}")
+
+    with stage("totals"):
+        for title, ids in total_sections(snapshot):
+            print(f"\nTotal {title}:", len(ids), format_latex_list(ids))
+        print("\nDuplicate Files:", len(snapshot.duplicate_files), "in", len(duplicate_ids(snapshot)), "IDs",
+              format_latex_list(duplicate_ids(snapshot)))
+
+    with stage("category_summaries"):
+        print_category_summaries(folder_mapping)
 
-    print("\nTotal Patient IDs:", len(total_patient_ids(folder_mapping)), format_latex_list(total_patient_ids(folder_mapping)))
-    print("\nTotal Face Scans:", len(total_face_scans(directory)), format_latex_list(total_face_scans(directory)))
-    print("\nTotal Masks:", len(total_masks(directory)), format_latex_list(total_masks(directory)))
-    print("\nTotal Templates:", len(total_templates(directory)), format_latex_list(total_templates(directory)))
-    print("\nTotal Datasheets:", len(total_datasheet(directory)), format_latex_list(total_datasheet(directory)))
-    print("\nTotal Additional:", len(total_additional(directory)), format_latex_list(total_additional(directory)))
+    if output_dir:
+        with stage("render"):
+            for path in write_reports(snapshot, output_dir, formats):
+                print(f"Report written to {path}")
+    return snapshot
 
-    print_category_summaries(folder_mapping)
 
 if __name__ == "__main__":
+    # Set PIPELINE_METRICS (and optionally PIPELINE_PROFILE) to collect per-stage metrics
+    instrumentation.enable_from_environment()
     main()
+    instrumentation.finish()
@@ -0,0 +1,36 @@
+import multiprocessing
+import os
+import sys
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_DIR, "Demo"))
+
+import batch_processing  # noqa: E402
+
+
+def dying_process_file(input_path, output_path, lod_voxel_size=None):
+    output_path.write_bytes(b"aligned")
+    if input_path.name == "scan3.stl":
+        os._exit(1)  # like a worker killed for running out of memory
+
+
+@pytest.mark.skipif(multiprocessing.get_start_method() != "fork", reason="the workers must inherit the patch")
+def test_dead_worker_does_not_stop_the_batch(tmp_path, monkeypatch):
+    monkeypatch.setattr(batch_processing, "process_file", dying_process_file)
+    inputs = []
+    for i in range(8):
+        inputs.append(tmp_path / f"scan{i}.stl")
+        inputs[-1].write_bytes(b"scan")
+
+    results = batch_processing.process_batch(inputs, tmp_path / "out", workers=2)
+
+    assert [result.input_path for result in results] == inputs
+    failed = [result for result in results if result.error]
+    assert "scan3.stl" in [result.input_path.name for result in failed]
+    assert all("BrokenProcessPool" in result.error for result in failed)
+    # Scans after the dead worker were still processed, and the lost ones left no output behind
+    assert not results[-1].error
+    assert sorted(os.listdir(tmp_path / "out")) == sorted(result.input_path.name for result in results
+                                                          if not result.error)
@@ -0,0 +1,83 @@
+import hashlib
+import os
+import sys
+import zipfile
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from dedup import HASH_INDEX_FILENAME, cache_key, load_hash_index, save_hash_index  # noqa: E402
+from new_files_script import group_files_by_id, merge_to_root, plan_zip_ingest  # noqa: E402
+
+
+def write(path, content, mtime_ns=None):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(content)
+    if mtime_ns is not None:
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+    return path
+
+
+def ingest_folder(processing, folder, files):
+    for name, content, *mtime_ns in files:
+        write(processing / folder / name, content, *mtime_ns)
+    duplicates = merge_to_root(str(processing))
+    group_files_by_id(str(processing))
+    return duplicates
+
+
+def test_same_content_across_batches_is_dropped(tmp_path):
+    processing = tmp_path / "Processing"
+    ingest_folder(processing, "Batch1", [("12345_face_scan.stl", b"scan")])
+    duplicates = ingest_folder(processing, "Batch2", [("12345_face_scan.stl", b"scan"), ("12345_mask.stl", b"mask")])
+
+    assert [src for src, _ in duplicates] == [str(processing / "Batch2" / "12345_face_scan.stl")]
+    assert sorted(os.listdir(processing / "12345")) == ["12345_face_scan.stl", "12345_mask.stl"]
+    assert (processing / "12345" / "12345_face_scan.stl").read_bytes() == b"scan"
+
+
+def test_same_cache_key_with_other_content_is_kept(tmp_path):
+    # Same name, size and mtime: the cached hash of the first file is also found for the second one
+    processing = tmp_path / "Processing"
+    mtime_ns = 1_600_000_000_000_000_000
+    ingest_folder(processing, "Batch1", [("12345_face_scan.stl", b"scan A", mtime_ns)])
+    duplicates = ingest_folder(processing, "Batch2", [("12345_face_scan.stl", b"scan B", mtime_ns)])
+
+    assert duplicates == []
+    folder = processing / "12345"
+    assert (folder / "12345_face_scan.stl").read_bytes() == b"scan A"
+    assert (folder / "12345_face_scan_additional.stl").read_bytes() == b"scan B"
+
+
+def make_archive(path, members):
+    with zipfile.ZipFile(path, "w") as zip_ref:
+        for name, content in members.items():
+            zip_ref.writestr(name, content)
+    return path
+
+
+def test_member_identical_to_a_grouped_file_is_skipped(tmp_path):
+    processing = tmp_path / "Processing"
+    existing = write(processing / "12345" / "12345_face_scan.stl", b"scan")
+    archive = make_archive(tmp_path / "p.zip", {"Scan/12345.01.02.stl": b"scan", "Scan/12345_g.stl": b"mask"})
+
+    plan = plan_zip_ingest(str(archive), str(processing), {})
+
+    entries = {entry["member"]: entry for entry in plan}
+    assert entries["Scan/12345.01.02.stl"]["duplicate_of"] == str(existing)
+    assert entries["Scan/12345.01.02.stl"]["target"] is None
+    assert entries["Scan/12345_g.stl"]["target"] == str(processing / "12345" / "12345_mask.stl")
+
+
+def test_member_matching_a_stale_cached_hash_is_kept(tmp_path):
+    # The cached hash of the existing file is that of the member, but the bytes differ
+    processing = tmp_path / "Processing"
+    existing = write(processing / "12345" / "12345_face_scan.stl", b"scan A")
+    hash_index_path = str(processing / HASH_INDEX_FILENAME)
+    save_hash_index(hash_index_path, {cache_key(existing, os.stat(existing)): hashlib.sha256(b"scan B").hexdigest()})
+    archive = make_archive(tmp_path / "p.zip", {"Scan/12345.01.02.stl": b"scan B"})
+
+    plan = plan_zip_ingest(str(archive), str(processing), load_hash_index(hash_index_path))
+
+    assert plan == [{"member": "Scan/12345.01.02.stl", "size": 6,
+                     "target": str(processing / "12345" / "12345_face_scan_additional.stl")}]
@@ -0,0 +1,131 @@
+import json
+import os
+import sys
+import zipfile
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from new_files_script import handle_new_files, stream_zip_to_processing  # noqa: E402
+
+# A scan project export: files one and two folders deep are renamed; "Redo" collides with "Project" and "Copy"
+# holds a byte-identical copy
+FIRST_BATCH = {
+    "root_notes.txt": b"notes",
+    "Project/12345.01.02.stl": b"scan 12345",
+    "Project/12345_g.stl": b"mask 12345",
+    "Project/12345.png": b"sheet 12345",
+    "Project/Patients/23456.03.04.stl": b"scan 23456",
+    "Project/Patients/23456.03.04a.stl": b"template 23456",
+    "Redo/12345.01.02.stl": b"scan 12345 redo",
+    "Copy/12345_g.stl": b"mask 12345",
+    "Copy/overview.xlsx": b"table",
+}
+
+# A later export: a new scan, a copy of a grouped file, names taken by the first batch and a file too deep to be
+# renamed. The classic path also renames the files of earlier batches and overwrites files in the root of
+# Processing when it extracts, so this batch has no unrenamed file for a later batch and no root file.
+SECOND_BATCH = {
+    "Project/12345.01.02.stl": b"scan 12345 again",
+    "Project/23456.03.04a.stl": b"template 23456",
+    "Project/45678.07.08.stl": b"scan 45678",
+    "Project/Patients/Deep/34567.05.06.stl": b"scan 34567",
+}
+
+
+def make_archive(path, members):
+    with zipfile.ZipFile(path, "w") as zip_ref:
+        for name, content in members.items():
+            zip_ref.writestr(name, content)
+    return str(path)
+
+
+def read_tree(folder):
+    # Relative path and content of every file, without the hidden bookkeeping files
+    tree = {}
+    for root, _, files in os.walk(folder):
+        for file in files:
+            if not file.startswith("."):
+                path = os.path.join(root, file)
+                with open(path, "rb") as f:
+                    tree[os.path.relpath(path, folder)] = f.read()
+    return tree
+
+
+def ingest_batches(folder, streaming, dedup):
+    folder.mkdir()
+    for i, members in enumerate((FIRST_BATCH, SECOND_BATCH)):
+        handle_new_files(make_archive(folder / f"batch{i}.zip", members), is_zip=True, streaming=streaming,
+                         dedup=dedup)
+    return read_tree(folder / "Processing")
+
+
+@pytest.mark.parametrize("dedup", [True, False])
+def test_streaming_matches_extract_rename_merge_group(tmp_path, dedup):
+    classic = ingest_batches(tmp_path / "classic", streaming=False, dedup=dedup)
+    streamed = ingest_batches(tmp_path / "streamed", streaming=True, dedup=dedup)
+
+    assert streamed == classic
+    assert classic["12345/12345_face_scan_additional_additional.stl"] == b"scan 12345 again"
+    assert classic["34567/34567.05.06.stl"] == b"scan 34567"
+    # The copies are only kept as "_additional" files without dedup
+    assert ("12345/12345_mask_additional.stl" in classic) != dedup
+    assert ("23456/23456_template_additional.stl" in classic) != dedup
+
+
+def test_root_member_does_not_overwrite_an_earlier_batch(tmp_path):
+    processing = tmp_path / "Processing"
+    for i in range(2):
+        zip_path = make_archive(tmp_path / f"batch{i}.zip", {"12345.01.02.stl": f"scan {i}".encode()})
+        stream_zip_to_processing(zip_path, str(processing))
+
+    assert read_tree(processing) == {"12345/12345.01.02.stl": b"scan 0", "12345/12345.01.02_additional.stl": b"scan 1"}
+
+
+def interrupt_ingest(zip_path, processing, monkeypatch, files_written=3):
+    # Loses the connection after a few files, leaving the plan and the journal behind; returns the written files
+    real_replace = os.replace
+    replaced = []
+
+    def failing_replace(src, dst):
+        if len(replaced) == files_written:
+            raise OSError("connection to the share was lost")
+        real_replace(src, dst)
+        replaced.append(dst)
+
+    monkeypatch.setattr(os, "replace", failing_replace)
+    with pytest.raises(OSError):
+        stream_zip_to_processing(zip_path, str(processing), workers=1)
+    monkeypatch.undo()
+    return replaced
+
+
+@pytest.mark.parametrize("stale_journal", [False, True])
+def test_interrupted_ingest_resumes(tmp_path, monkeypatch, stale_journal):
+    expected_folder = tmp_path / "expected"
+    expected_folder.mkdir()
+    stream_zip_to_processing(make_archive(expected_folder / "p.zip", FIRST_BATCH), str(expected_folder / "Processing"),
+                             workers=1)
+
+    folder = tmp_path / "interrupted"
+    processing = folder / "Processing"
+    processing.mkdir(parents=True)
+    if stale_journal:
+        # Left by an interrupted ingest of another archive with the same name
+        (processing / ".ingest_p.zip.plan.json").write_text(json.dumps({"zip_size": 1, "entries": []}))
+        (processing / ".ingest_p.zip.done").write_text("Project/12345.01.02.stl\n")
+    zip_path = make_archive(folder / "p.zip", FIRST_BATCH)
+    replaced = interrupt_ingest(zip_path, processing, monkeypatch)
+    assert sorted(name for name in os.listdir(processing) if name.startswith(".ingest_")) == [
+        ".ingest_p.zip.done", ".ingest_p.zip.plan.json"]
+
+    written_before = {path: os.stat(path).st_mtime_ns for path in replaced}
+    stream_zip_to_processing(zip_path, str(processing), workers=1)
+
+    assert read_tree(processing) == read_tree(expected_folder / "Processing")
+    # The files written before the interruption are kept, and no journal or partial file is left behind
+    assert {path: os.stat(path).st_mtime_ns for path in replaced} == written_before
+    assert not [name for _, _, files in os.walk(processing) for name in files
+                if name.startswith(".ingest_") or name.endswith(".part")]
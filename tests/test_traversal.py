@@ -0,0 +1,61 @@
+import os
+import sys
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from benchmark_script import network_latency  # noqa: E402
+from traversal import walk_concurrent  # noqa: E402
+
+LATENCY = 0.02
+
+
+def make_tree(root):
+    # Patient folders with scans, each with a nested folder, plus an empty folder
+    for patient in range(10):
+        folder = root / f"1234{patient}"
+        (folder / "Extra").mkdir(parents=True)
+        (folder / f"1234{patient}_face_scan.stl").write_bytes(b"scan")
+        (folder / "Extra" / "notes.txt").write_bytes(b"notes")
+    (root / "Empty").mkdir()
+    (root / "datasheet.xlsx").write_bytes(b"sheet")
+
+
+def sorted_walk(results):
+    return sorted((root, sorted(dirs), sorted(files)) for root, dirs, files in results)
+
+
+def test_walk_concurrent_matches_os_walk(tmp_path):
+    make_tree(tmp_path)
+    with network_latency(LATENCY):
+        expected = sorted_walk(os.walk(tmp_path))
+        start = time.perf_counter()
+        result = sorted_walk(walk_concurrent(str(tmp_path)))
+        elapsed = time.perf_counter() - start
+
+    assert result == expected
+    # Listing the 22 folders one after another would take 22 round trips
+    assert elapsed < len(expected) * LATENCY / 2
+
+
+def test_unreadable_folders_are_skipped(tmp_path, monkeypatch, capsys):
+    make_tree(tmp_path)
+    unreadable = {str(tmp_path / "12343"), str(tmp_path / "12347" / "Extra")}
+    with network_latency(LATENCY):
+        slow_scandir = os.scandir
+
+        def failing_scandir(path="."):
+            if str(path) in unreadable:
+                raise PermissionError(13, "Permission denied", str(path))
+            return slow_scandir(path)
+
+        monkeypatch.setattr(os, "scandir", failing_scandir)
+        expected = sorted_walk(os.walk(tmp_path))
+        result = sorted_walk(walk_concurrent(str(tmp_path)))
+        monkeypatch.undo()
+
+    # Like os.walk, the unreadable folders are still listed in their parent but not descended into
+    assert result == expected
+    assert not any(root in unreadable for root, _, _ in result)
+    assert capsys.readouterr().out.count("Warning: could not list") == len(unreadable)
@@ -0,0 +1,68 @@
+import os
+import sys
+import zipfile
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import watch_folder  # noqa: E402
+
+
+def make_archive(path, batch):
+    # The same names in every archive, with different content, like successive exports of one scan project
+    with zipfile.ZipFile(path, "w") as zip_ref:
+        zip_ref.writestr("Scan/12345.01.02.stl", f"scan of batch {batch}".encode())
+        zip_ref.writestr("Scan/12345_g.stl", f"mask of batch {batch}".encode())
+
+
+def test_concurrent_archives_are_all_ingested(tmp_path):
+    inbox = tmp_path / "inbox"
+    inbox.mkdir()
+    for batch in range(4):
+        make_archive(inbox / f"batch{batch}.zip", batch)
+
+    state = watch_folder.watch(inbox, tmp_path / "processed", workers=4, settle_seconds=0, poll_interval=0.01,
+                               once=True)
+
+    assert {name: entry["status"] for name, entry in state.items()} == {f"batch{i}.zip": "done" for i in range(4)}
+    patient_folder = inbox / "Processing" / "12345"
+    contents = sorted((patient_folder / name).read_bytes() for name in os.listdir(patient_folder))
+    expected = sorted(f"{kind} of batch {batch}".encode() for kind in ("scan", "mask") for batch in range(4))
+    assert contents == expected
+    assert not list(patient_folder.glob("*.part"))
+
+
+def test_transient_failures_are_retried(tmp_path, monkeypatch):
+    inbox = tmp_path / "inbox"
+    inbox.mkdir()
+    make_archive(inbox / "batch0.zip", 0)
+    ingest_zip = watch_folder.ingest_zip
+    calls = []
+
+    def flaky_ingest_zip(zip_path, workers=4):
+        calls.append(zip_path)
+        if len(calls) == 1:
+            raise PermissionError("locked by another process")
+        ingest_zip(zip_path, workers)
+
+    monkeypatch.setattr(watch_folder, "ingest_zip", flaky_ingest_zip)
+    state = watch_folder.watch(inbox, tmp_path / "processed", settle_seconds=0, poll_interval=0.01, once=True)
+
+    assert len(calls) == 2
+    assert state["batch0.zip"]["status"] == "done"
+    assert watch_folder.load_watch_state(inbox)["batch0.zip"]["status"] == "done"
+
+
+def test_persistent_failures_are_recorded(tmp_path, monkeypatch):
+    inbox = tmp_path / "inbox"
+    inbox.mkdir()
+    make_archive(inbox / "batch0.zip", 0)
+
+    def failing_ingest_zip(zip_path, workers=4):
+        raise PermissionError("locked by another process")
+
+    monkeypatch.setattr(watch_folder, "ingest_zip", failing_ingest_zip)
+    state = watch_folder.watch(inbox, tmp_path / "processed", settle_seconds=0, poll_interval=0.01, once=True)
+
+    assert state["batch0.zip"]["status"] == "failed"
+    assert "PermissionError" in state["batch0.zip"]["error"]
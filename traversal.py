@@ -0,0 +1,56 @@
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+# Directory listings on a network share are mostly waiting for round trips, so many can run at once
+DEFAULT_WORKERS = 16
+
+
+def join_relative(root, relative_path):
+    return os.path.join(root, relative_path) if relative_path else root
+
+
+def list_directory(path):
+    # Uses the entry types returned with the listing instead of one isdir/isfile call per entry
+    dirs, files = [], []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                dirs.append(entry.name)
+            elif not entry.is_dir():
+                files.append(entry.name)
+    return sorted(dirs), sorted(files)
+
+
+def traverse(root, visit, workers=DEFAULT_WORKERS):
+    # visit(relative_path) runs in a worker thread and returns (result, subdirectories to descend into).
+    # Results are yielded as soon as they are ready, in no particular order.
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        pending = {executor.submit(visit, ""): ""}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                relative_path = pending.pop(future)
+                try:
+                    result, subdirs = future.result()
+                except OSError as e:
+                    print(f"Warning: could not list {join_relative(root, relative_path)}: {e}")
+                    continue
+                for name in subdirs:
+                    child = os.path.join(relative_path, name)
+                    pending[executor.submit(visit, child)] = child
+                yield relative_path, result
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def walk_concurrent(top, workers=DEFAULT_WORKERS):
+    # Like os.walk(top) without followlinks, but directories are listed concurrently and come in completion order
+    def visit(relative_path):
+        path = join_relative(top, relative_path)
+        dirs, files = list_directory(path)
+        return (path, dirs, files), dirs
+
+    for _, result in traverse(top, visit, workers):
+        yield result
@@ -0,0 +1,263 @@
+import json
+import os
+import queue
+import shutil
+import sys
+import threading
+import time
+import zipfile
+from pathlib import Path
+
+import instrumentation
+
+# The scan processing modules live in Demo
+sys.path.insert(0, str(Path(__file__).resolve().parent / "Demo"))
+
+
+WATCH_STATE_FILENAME = ".watch_state.json"
+WATCHED_SUFFIXES = (".zip", ".stl")
+
+# A file whose handling fails with an OSError (e.g. still locked by the program copying it) is tried again on later
+# scans, up to this many times, before it is recorded as failed
+MAX_ATTEMPTS = 3
+
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:  # Not installed or not Linux: the inbox is polled
+    INotify = None
+
+
+def load_watch_state(inbox):
+    state_path = os.path.join(inbox, WATCH_STATE_FILENAME)
+    if os.path.isfile(state_path):
+        try:
+            with open(state_path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Warning: ignoring unreadable watch state {state_path}: {e}")
+    return {}
+
+
+def save_watch_state(inbox, state):
+    state_path = os.path.join(inbox, WATCH_STATE_FILENAME)
+    temp_path = state_path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f, indent=1)
+    os.replace(temp_path, state_path)
+
+
+def scan_inbox(inbox):
+    # Only ZIP and STL files directly in the inbox; hidden and partial files (e.g. "x.zip.part") are ignored
+    listing = {}
+    with os.scandir(inbox) as entries:
+        for entry in entries:
+            if entry.name.startswith('.') or not entry.name.lower().endswith(WATCHED_SUFFIXES):
+                continue
+            if entry.is_file(follow_symlinks=False):
+                stat = entry.stat()
+                listing[entry.name] = (stat.st_size, stat.st_mtime_ns)
+    return listing
+
+
+def is_complete(path):
+    # A ZIP is readable only once its central directory (written last) is there; binary STL sizes are checked
+    # against their triangle count. ASCII STL files rely on the settle time alone.
+    if path.lower().endswith(".zip"):
+        return zipfile.is_zipfile(path)
+    from stl_io import is_binary_stl
+    with open(path, "rb") as f:
+        header = f.read(5)
+    return header.lower() == b"solid" or is_binary_stl(path)
+
+
+def settled_files(listing, observed, now, settle_seconds):
+    # Files whose size and mtime have not changed for settle_seconds; `observed` keeps when each was first seen
+    settled = []
+    for name, signature in listing.items():
+        first_seen = observed.get(name)
+        if first_seen is None or first_seen[0] != signature:
+            observed[name] = (signature, now)
+        elif now - first_seen[1] >= settle_seconds:
+            settled.append(name)
+    for name in set(observed) - set(listing):
+        del observed[name]
+    return sorted(settled)
+
+
+def ingest_zip(zip_path, workers=4):
+    from new_files_script import handle_new_files
+    handle_new_files(zip_path, is_zip=True, streaming=True, workers=workers)
+
+
+def process_stl(stl_path, processed_folder, lock):
+    # Aligns one scan into a staging folder, then numbers, files and records it like Demo/main.py does
+    from file_organizing import organize_files, rename_files
+    from file_processing import process_file
+    from manifest import find_unprocessed, next_index, open_manifest, record_outputs
+
+    stl_path = Path(stl_path)
+    processed_folder = Path(processed_folder)
+    with lock:
+        os.makedirs(processed_folder, exist_ok=True)
+        manifest = open_manifest(processed_folder)
+        try:
+            pending = find_unprocessed(manifest, [stl_path])
+        finally:
+            manifest.close()
+    if not pending:
+        return None
+
+    staging_folder = processed_folder / f".watch_{stl_path.stem}"
+    os.makedirs(staging_folder, exist_ok=True)
+    try:
+        process_file(stl_path, staging_folder / stl_path.name)
+        with lock:
+            manifest = open_manifest(processed_folder)
+            try:
+                index = next_index(manifest, processed_folder)
+                renamed_files = rename_files(staging_folder, index)
+                final_filepaths = organize_files(renamed_files, processed_folder)
+                record_outputs(manifest, [(stl_path, pending[0][1], final_filepaths[0], index)])
+            finally:
+                manifest.close()
+    finally:
+        shutil.rmtree(staging_folder, ignore_errors=True)
+    return final_filepaths[0]
+
+
+def handle_inbox_file(path, processed_folder, lock, ingest_lock, zip_workers=4):
+    # Every archive is streamed into the same Processing folder and hash index, and its plan depends on the files
+    # already there, so only one archive is ingested at a time
+    if path.lower().endswith(".zip"):
+        with ingest_lock:
+            ingest_zip(path, zip_workers)
+        return None
+    return process_stl(path, processed_folder, lock)
+
+
+def watch(inbox, processed_folder, workers=2, queue_size=4, poll_interval=2.0, settle_seconds=5.0, once=False,
+          stop_event=None):
+    # Runs until stop_event is set (or, with once=True, until every file in the inbox is handled).
+    # Settled files go into a bounded queue; when the workers fall behind, the scanner waits for room.
+    # Handled (and failed) files are recorded in the watch state with their size and mtime, so a restart skips
+    # them; a file is handled again only when it changes. Transient failures are retried (see MAX_ATTEMPTS).
+    inbox = os.fspath(inbox)
+    state = load_watch_state(inbox)
+    state_lock = threading.Lock()
+    pipeline_lock = threading.Lock()
+    ingest_lock = threading.Lock()
+    attempts = {}
+    work = queue.Queue(maxsize=queue_size)
+    queued = set()
+    stop_event = stop_event or threading.Event()
+
+    def worker():
+        while True:
+            item = work.get()
+            if item is None:
+                work.task_done()
+                return
+            name, signature = item
+            path = os.path.join(inbox, name)
+            print(f"Handling {name}")
+            entry = {"size": signature[0], "mtime_ns": signature[1], "finished": time.time()}
+            try:
+                output = handle_inbox_file(path, processed_folder, pipeline_lock, ingest_lock)
+                entry["status"] = "done"
+                if output is not None:
+                    entry["output"] = str(output)
+                instrumentation.count("watch_files_done")
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+                with state_lock:
+                    attempts[item] = attempts.get(item, 0) + 1
+                    retry = isinstance(e, OSError) and attempts[item] < MAX_ATTEMPTS
+                if retry:
+                    entry = None
+                    instrumentation.count("watch_files_retried")
+                    print(f"Will retry: {name} ({error})")
+                else:
+                    entry.update(status="failed", error=error)
+                    instrumentation.count("watch_files_failed")
+                    print(f"Failed: {name} ({error})")
+            with state_lock:
+                if entry is not None:
+                    state[name] = entry
+                    save_watch_state(inbox, state)
+                queued.discard(name)
+            work.task_done()
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+
+    notifier = None
+    if INotify is not None:
+        notifier = INotify()
+        notifier.add_watch(inbox, inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_TO | inotify_flags.CREATE)
+
+    def is_handled(name, signature):
+        entry = state.get(name)
+        return entry is not None and (entry["size"], entry["mtime_ns"]) == signature
+
+    observed = {}
+    try:
+        while not stop_event.is_set():
+            listing = scan_inbox(inbox)
+            settled = settled_files(listing, observed, time.monotonic(), settle_seconds)
+            waiting = len(settled) < len(listing)
+            for name in settled:
+                signature = listing[name]
+                with state_lock:
+                    if is_handled(name, signature) or name in queued:
+                        continue
+                if not is_complete(os.path.join(inbox, name)):
+                    waiting = True
+                    continue
+                with state_lock:
+                    queued.add(name)
+                work.put((name, signature))  # Blocks while the queue is full
+            if once and not waiting:
+                work.join()
+                with state_lock:
+                    retrying = not all(is_handled(name, signature) for name, signature in listing.items())
+                if not retrying:
+                    if scan_inbox(inbox) == listing:
+                        break
+                    continue
+            if notifier is not None:
+                notifier.read(timeout=int(poll_interval * 1000))
+            else:
+                stop_event.wait(poll_interval)
+    finally:
+        for _ in threads:
+            work.put(None)
+        for thread in threads:
+            thread.join()
+        if notifier is not None:
+            notifier.close()
+    return state
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Watch an inbox folder and ingest new ZIP archives and STL scans.")
+    parser.add_argument("inbox", help="folder where new ZIP archives and STL scans are dropped")
+    parser.add_argument("processed_folder", help="folder where the aligned STL scans are organized")
+    parser.add_argument("--workers", type=int, default=2, help="files handled at once")
+    parser.add_argument("--queue-size", type=int, default=4, help="settled files waiting for a worker")
+    parser.add_argument("--poll-interval", type=float, default=2.0, help="seconds between inbox scans")
+    parser.add_argument("--settle-seconds", type=float, default=5.0,
+                        help="seconds a file must stay unchanged before it is handled")
+    parser.add_argument("--once", action="store_true", help="handle the files in the inbox, then exit")
+    args = parser.parse_args()
+
+    # Set PIPELINE_METRICS (and optionally PIPELINE_PROFILE) to collect per-stage metrics
+    instrumentation.enable_from_environment()
+    try:
+        watch(args.inbox, args.processed_folder, args.workers, args.queue_size, args.poll_interval,
+              args.settle_seconds, args.once)
+    except KeyboardInterrupt:
+        print("Stopped.")
+    instrumentation.finish()